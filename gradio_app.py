@@ -1,10 +1,11 @@
 import argparse
-import gc
 import json
 import os
 import sys
 import tempfile
+import time
 import uuid
+import queue
 from threading import Thread
 
 import gradio as gr
@@ -22,6 +23,7 @@ from transformers.models.phi3.modeling_phi3 import Phi3PreTrainedModel
 import lib_omost.canvas as omost_canvas
 import lib_omost.memory_management as memory_management
 from chat_interface import ChatInterface
+from lib_omost.embedding_cache import EmbeddingCache
 from lib_omost.pipeline import StableDiffusionXLOmostPipeline
 
 os.environ['HF_HOME'] = os.path.join(os.path.dirname(__file__), 'hf_download')
@@ -43,6 +45,22 @@ parser.add_argument("--llm_folder", type=str, default=os.path.join(os.path.dirna
 parser.add_argument("--outputs_folder", type=str, default=os.path.join(os.path.dirname(__file__), "outputs"))
 # Add a --no-defaults flag to disable the default models
 parser.add_argument("--no_defaults", action='store_true')
+parser.add_argument("--embedding_cache_mb", type=int, default=512)
+parser.add_argument("--embedding_cache_dir", type=str, default=None)
+parser.add_argument("--canvas_cache_size", type=int, default=1024)
+# Models kept on the GPU at once, 0 keeps only the models in use, a negative value never moves them back
+parser.add_argument("--vram_budget_gb", type=float, default=0.0)
+# cuda, cpu, an explicit device such as cuda:1 or a device index, created when the first model is loaded
+parser.add_argument("--device", type=str, default='cuda')
+# Keep the UNet on the CPU and stream its blocks to the device while sampling, slower but needs far less VRAM
+parser.add_argument("--sequential_offload", action='store_true')
+parser.add_argument("--sequential_offload_block_mb", type=float, default=None)
+# Appends one JSON line per model transfer to this file
+parser.add_argument("--transfer_log", type=str, default=None)
+# Merge duplicate regions and drop occluded ones before encoding, changes results slightly
+parser.add_argument("--optimize_regions", action='store_true')
+# Encode canvas regions on the CPU while the LLM is still streaming them
+parser.add_argument("--early_encoding", action='store_true')
 args = parser.parse_args()
 
 DEFAULT_CHECKPOINTS = {
@@ -69,6 +87,13 @@ selected_lora = None
 llm_model = None
 llm_model_name = None
 llm_tokenizer = None
+embedding_cache = EmbeddingCache(max_bytes=args.embedding_cache_mb * 1024 * 1024, disk_dir=args.embedding_cache_dir)
+early_encoder = None
+canvas_cache = omost_canvas.CanvasOutputsCache(max_entries=args.canvas_cache_size)
+
+memory_management.set_device(args.device)
+memory_management.set_transfer_log(args.transfer_log)
+memory_management.set_budget(None if args.vram_budget_gb < 0 else int(args.vram_budget_gb * 1024 ** 3))
 
 os.makedirs(args.outputs_folder, exist_ok=True)
 
@@ -134,16 +159,15 @@ def load_pipeline(model_path, lora):
         return
 
     if pipeline:
+        memory_management.forget_models([pipeline.text_encoder, pipeline.text_encoder_2, pipeline.vae, pipeline.unet])
         pipeline = None
-        torch.cuda.empty_cache()
-        gc.collect()
+        memory_management.empty_cache()
 
     print(f"Loading model from {model_path}")
 
     if model_path.endswith('.safetensors'):
         pipeline = StableDiffusionXLImg2ImgPipeline.from_single_file(model_path, torch_dtype=torch.float16,
                                                                      variant="fp16")
-        pipeline = pipeline.to(memory_management.gpu)
         tokenizer = pipeline.tokenizer
         tokenizer_2 = pipeline.tokenizer_2
         text_encoder = pipeline.text_encoder
@@ -172,6 +196,11 @@ def load_pipeline(model_path, lora):
         unet=unet,
         scheduler=None,  # We completely give up diffusers sampling system and use A1111's method
     )
+    memory_management.name_models(dict(text_encoder=text_encoder, text_encoder_2=text_encoder_2, vae=vae, unet=unet))
+    pipeline.embedding_cache = embedding_cache
+    pipeline.model_identity = model_path
+    if os.path.isfile(model_path):
+        pipeline.model_identity = f'{model_path}:{os.path.getmtime(model_path)}'
     if lora is not None and lora != "" and os.path.exists(lora):
         print(f"Loading Lora from {lora}")
         if selected_lora != "" and selected_lora is not None:
@@ -181,7 +210,6 @@ def load_pipeline(model_path, lora):
     else:
         pipeline.unload_lora_weights()
 
-    pipeline = pipeline.to(torch.device('cuda'))
     loaded_pipeline = model_path
 
 
@@ -190,18 +218,24 @@ def load_llm_model(model_name, do_unload: bool = True):
     if llm_model_name == model_name and llm_model:
         return
     if llm_model:
+        memory_management.forget_models([llm_model])
         del llm_model
     if llm_tokenizer:
         del llm_tokenizer
-    torch.cuda.empty_cache()
+    # Pre-quantized checkpoints are always loaded onto the device, so everything else is evicted first
+    memory_management.unload_all_models()
+    memory_management.empty_cache()
     print(f"Loading LLM model from {model_name}")
 
     llm_model = AutoModelForCausalLM.from_pretrained(
         model_name,
         torch_dtype=torch.bfloat16,
         token=HF_TOKEN,
-        device_map="auto"
+        device_map=memory_management.get_device()
     )
+    # Already on the device, this only registers it with the manager so that it is counted and evicted
+    memory_management.name_models(dict(llm=llm_model))
+    memory_management.load_models_to_gpu([llm_model])
     llm_tokenizer = AutoTokenizer.from_pretrained(
         model_name,
         token=HF_TOKEN
@@ -229,6 +263,17 @@ def numpy2pytorch(imgs):
     return h
 
 
+@torch.inference_mode()
+def box_blur(x, radius):
+    # Same as avg_pool2d with a (2r+1)x(2r+1) kernel over the reflect-padded image, computed with an
+    # integral image in float64 so the cost does not depend on the radius
+    k = radius * 2 + 1
+    s = torch.nn.functional.pad(x, (radius,) * 4, mode='reflect').double().cumsum(2).cumsum(3)
+    s = torch.nn.functional.pad(s, (1, 0, 1, 0))
+    y = (s[..., k:, k:] - s[..., :-k, k:] - s[..., k:, :-k] + s[..., :-k, :-k]) / (k * k)
+    return y.to(x.dtype)
+
+
 def resize_without_crop(image, target_width, target_height):
     pil_image = Image.fromarray(image)
     resized_image = pil_image.resize((target_width, target_height), Image.LANCZOS)
@@ -245,9 +290,74 @@ def random_seed():
         return np.random.randint(0, 2 ** 31 - 1)
 
 
+def get_lora_settings(lora_selection, lora_scale):
+    lora_info_dict = {}
+    if lora_selection != "" and os.path.exists(lora_selection):
+        lora_json = lora_selection.replace(".safetensors", ".json")
+        if os.path.exists(lora_json):
+            with open(lora_json, "r") as f:
+                lora_info_dict = json.load(f)
+    else:
+        lora_scale = 0
+
+    activation_text = lora_info_dict.get("activation text", None)
+    return lora_scale, activation_text
+
+
+class EarlyEncoder:
+    # Background worker that encodes the conditions found by CanvasStreamParser into the embedding cache.
+    # It must be joined before anything else uses the text encoders.
+
+    def __init__(self, lora_scale, activation_text):
+        self.lora_scale = lora_scale
+        self.activation_text = activation_text
+        self.queue = queue.Queue()
+        self.encoded = 0
+        self.thread = Thread(target=self.worker, daemon=True)
+        self.thread.start()
+        return
+
+    def submit(self, condition):
+        self.queue.put(condition)
+        return
+
+    def worker(self):
+        while True:
+            condition = self.queue.get()
+            if condition is None:
+                return
+            try:
+                if pipeline.encode_condition_early(condition['prefixes'], condition['suffixes'],
+                                                   self.lora_scale, self.activation_text):
+                    self.encoded += 1
+            except Exception as e:
+                print('Early encoding failed:', e)
+
+    def finish(self):
+        self.queue.put(None)
+        return
+
+    def join(self):
+        self.finish()
+        self.thread.join()
+        print(f'Early encoding: {self.encoded} conditions')
+        return
+
+
+def join_early_encoder():
+    global early_encoder
+    if early_encoder is not None:
+        early_encoder.join()
+        early_encoder = None
+    return
+
+
 @torch.inference_mode()
-def chat_fn(message: str, history: list, seed: int, temperature: float, top_p: float, max_new_tokens: int, lora: str) -> str:
-    global llm_model, llm_tokenizer, llm_model_name, pipeline
+def chat_fn(message: str, history: list, seed: int, temperature: float, top_p: float, max_new_tokens: int, lora: str,
+            lora_scale: float) -> str:
+    global llm_model, llm_tokenizer, llm_model_name, pipeline, early_encoder
+
+    join_early_encoder()
 
     if seed == -1:
         seed = random_seed()
@@ -262,8 +372,6 @@ def chat_fn(message: str, history: list, seed: int, temperature: float, top_p: f
                 conversation.extend([{"role": "user", "content": user}, {"role": "assistant", "content": assistant}])
 
     conversation.append({"role": "user", "content": message})
-    if pipeline:
-        pipeline = pipeline.to(memory_management.cpu)
     # Load the model if it is not loaded
     if not llm_model:
         load_llm_model(llm_model_name, False)
@@ -303,11 +411,22 @@ def chat_fn(message: str, history: list, seed: int, temperature: float, top_p: f
 
     Thread(target=llm_model.generate, kwargs=generate_kwargs).start()
 
+    stream_parser = None
+    if args.early_encoding and pipeline is not None:
+        stream_parser = omost_canvas.CanvasStreamParser()
+        early_encoder = EarlyEncoder(*get_lora_settings(lora, lora_scale))
+
     outputs = []
     for text in streamer:
         outputs.append(text)
+        if stream_parser is not None:
+            for condition in stream_parser.feed(text):
+                early_encoder.submit(condition)
         yield "".join(outputs), interrupter
 
+    if early_encoder is not None:
+        early_encoder.finish()
+
     return
 
 
@@ -320,8 +439,7 @@ def post_chat(history):
             history = [(user, assistant) for user, assistant in history if
                        isinstance(user, str) and isinstance(assistant, str)]
             last_assistant = history[-1][1] if len(history) > 0 else None
-            canvas = omost_canvas.Canvas.from_bot_response(last_assistant)
-            canvas_outputs = canvas.process()
+            canvas_outputs = canvas_cache.process_bot_response(last_assistant)
     except Exception as e:
         print('Last assistant response is not valid canvas:', e)
 
@@ -331,21 +449,12 @@ def post_chat(history):
 @torch.inference_mode()
 def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_height,
                  highres_scale, steps, cfg, highres_steps, highres_denoise, negative_prompt, model_selection,
-                 lora_selection, lora_scale):
+                 lora_selection, lora_scale, edit_strength, render_state):
     global pipeline, llm_model, llm_tokenizer
 
-    lora_info_dict = {}
-    if lora_selection != "" and os.path.exists(lora_selection):
-        lora_json = lora_selection.replace(".safetensors", ".json")
-        if os.path.exists(lora_json):
-            with open(lora_json, "r") as f:
-                lora_info_dict = json.load(f)
-    else:
-        lora_scale = 0
+    join_early_encoder()
+    lora_scale, activation_text = get_lora_settings(lora_selection, lora_scale)
 
-    activation_text = lora_info_dict.get("activation text", None)
-
-    memory_management.unload_all_models([llm_model])
     use_initial_latent = False
     eps = 0.05
     # Load the model
@@ -365,22 +474,63 @@ def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_
     image_width, image_height = int(image_width // 64) * 64, int(image_height // 64) * 64
     if seed == -1:
         seed = random_seed()
-    rng = torch.Generator(device=memory_management.gpu).manual_seed(seed)
+    rng = torch.Generator(device=memory_management.get_device()).manual_seed(seed)
+
+    # Edit rendering starts from the previous render's latents, unchanged regions hit the embedding cache.
+    # A canvas with another global description or without any unchanged region is not an edit of the previous one.
+    previous_latents = None
+    previous_canvas = render_state['canvas'] if render_state is not None else None
+    if previous_canvas is not None and canvas_outputs.get('canvas') is not None and edit_strength < 1.0 - eps:
+        changes = omost_canvas.diff_canvases(previous_canvas, canvas_outputs['canvas'])
+        print(f'Canvas diff: {len(changes["unchanged"])} unchanged, {len(changes["modified"])} modified, '
+              f'{len(changes["added"])} added, {len(changes["removed"])} removed, '
+              f'global {"changed" if changes["global_changed"] else "unchanged"}')
+        is_edit = not changes['global_changed'] and \
+            (len(changes['unchanged']) > 0 or len(canvas_outputs['canvas'].components) == 0)
+        if not is_edit:
+            print('Canvas is not an edit of the previous render, rendering from noise.')
+        elif tuple(render_state['latents'].shape[-2:]) == (image_height // 8, image_width // 8):
+            previous_latents = render_state['latents']
+        else:
+            print('Previous render has a different size, rendering from noise.')
+
+    if args.optimize_regions:
+        canvas_outputs = omost_canvas.optimize_bag_of_conditions(canvas_outputs, image_height // 8, image_width // 8)
+
+    # Each stage prefetches the model of the next one, so transfers overlap with compute
+    stage_times = {}
+
+    # With sequential offload the UNet is never loaded as a whole
+    unet_models = [] if args.sequential_offload else [unet]
+    if args.sequential_offload:
+        memory_management.unload_models([unet])
+    sequential_offload_block_bytes = None
+    if args.sequential_offload_block_mb is not None:
+        sequential_offload_block_bytes = int(args.sequential_offload_block_mb * 1024 ** 2)
+    stage_start = time.perf_counter()
 
     memory_management.load_models_to_gpu([text_encoder, text_encoder_2])
+    memory_management.prefetch_models_to_gpu(unet_models)
 
     positive_cond, positive_pooler, negative_cond, negative_pooler = pipeline.all_conds_from_canvas(canvas_outputs,
                                                                                                     negative_prompt,
                                                                                                     lora_scale,
                                                                                                     activation_text)
+    print('Embedding cache:', embedding_cache.stats())
+    stage_times['encode'] = time.perf_counter() - stage_start
 
-    if use_initial_latent:
+    strength = 1.0
+
+    if previous_latents is not None:
+        repeats = (num_samples + previous_latents.size(0) - 1) // previous_latents.size(0)
+        initial_latent = previous_latents.repeat(repeats, 1, 1, 1)[:num_samples]
+        strength = edit_strength
+    elif use_initial_latent:
         memory_management.load_models_to_gpu([vae])
         initial_latent = torch.from_numpy(canvas_outputs['initial_latent'])[None].movedim(-1, 1) / 127.5 - 1.0
         initial_latent_blur = 40
-        initial_latent = torch.nn.functional.avg_pool2d(
-            torch.nn.functional.pad(initial_latent, (initial_latent_blur,) * 4, mode='reflect'),
-            kernel_size=(initial_latent_blur * 2 + 1,) * 2, stride=(1, 1))
+        # blur at the 90*90 layout resolution, upsampling comes after
+        initial_latent = box_blur(initial_latent, initial_latent_blur)
         initial_latent = torch.nn.functional.interpolate(initial_latent, (image_height, image_width))
         initial_latent = initial_latent.to(dtype=vae.dtype, device=vae.device)
         try:
@@ -394,13 +544,15 @@ def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_
     else:
         initial_latent = torch.zeros(size=(num_samples, 4, image_height // 8, image_width // 8), dtype=torch.float32)
 
-    memory_management.load_models_to_gpu([unet])
+    stage_start = time.perf_counter()
+    memory_management.load_models_to_gpu(unet_models)
+    memory_management.prefetch_models_to_gpu([vae])
 
-    initial_latent = initial_latent.to(dtype=unet.dtype, device=unet.device)
+    initial_latent = initial_latent.to(dtype=unet.dtype, device=memory_management.get_device())
     print("Starting diffusion")
     latents = pipeline(
         initial_latent=initial_latent,
-        strength=1.0,
+        strength=strength,
         num_inference_steps=int(steps),
         batch_size=num_samples,
         prompt_embeds=positive_cond,
@@ -410,15 +562,25 @@ def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_
         generator=rng,
         cross_attention_kwargs={"scale": lora_scale},
         guidance_scale=float(cfg),
+        sequential_offload=args.sequential_offload,
+        sequential_offload_block_bytes=sequential_offload_block_bytes,
     ).images
 
+    render_state = dict(canvas=canvas_outputs.get('canvas'), latents=latents.cpu())
+    stage_times['diffusion'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
     memory_management.load_models_to_gpu([vae])
+    if highres_scale > 1.0 + eps:
+        memory_management.prefetch_models_to_gpu(unet_models)
     latents = latents.to(dtype=vae.dtype, device=vae.device) / vae.config.scaling_factor
     pixels = vae.decode(latents).sample
     B, C, H, W = pixels.shape
     pixels = pytorch2numpy(pixels)
+    stage_times['decode'] = time.perf_counter() - stage_start
     print("Diffusion done, doing hires")
     if highres_scale > 1.0 + eps:
+        stage_start = time.perf_counter()
         pixels = [
             resize_without_crop(
                 image=p,
@@ -430,8 +592,9 @@ def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_
         pixels = numpy2pytorch(pixels).to(device=vae.device, dtype=vae.dtype)
         latents = vae.encode(pixels).latent_dist.mode() * vae.config.scaling_factor
 
-        memory_management.load_models_to_gpu([unet])
-        latents = latents.to(device=unet.device, dtype=unet.dtype)
+        memory_management.load_models_to_gpu(unet_models)
+        memory_management.prefetch_models_to_gpu([vae])
+        latents = latents.to(device=memory_management.get_device(), dtype=unet.dtype)
 
         latents = pipeline(
             initial_latent=latents,
@@ -445,12 +608,15 @@ def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_
             cross_attention_kwargs={"scale": lora_scale},
             generator=rng,
             guidance_scale=float(cfg),
+            sequential_offload=args.sequential_offload,
+            sequential_offload_block_bytes=sequential_offload_block_bytes,
         ).images
 
         memory_management.load_models_to_gpu([vae])
         latents = latents.to(dtype=vae.dtype, device=vae.device) / vae.config.scaling_factor
         pixels = vae.decode(latents).sample
         pixels = pytorch2numpy(pixels)
+        stage_times['highres'] = time.perf_counter() - stage_start
 
     for i in range(len(pixels)):
         unique_hex = uuid.uuid4().hex
@@ -459,7 +625,9 @@ def diffusion_fn(chatbot, canvas_outputs, num_samples, seed, image_width, image_
         image.save(image_path)
         chatbot = chatbot + [(None, (image_path, 'image'))]
 
-    return chatbot
+    print('Stage timings:', {k: round(v, 3) for k, v in stage_times.items()})
+    print('Model transfers:', memory_management.get_transfer_stats())
+    return chatbot, render_state
 
 
 def update_model_list():
@@ -562,6 +730,8 @@ with gr.Blocks(
                                           step=0.01)
                 highres_steps = gr.Slider(label="Highres Fix Steps", minimum=1, maximum=100, value=20, step=1)
                 highres_denoise = gr.Slider(label="Highres Fix Denoise", minimum=0.1, maximum=1.0, value=0.4, step=0.01)
+                edit_strength = gr.Slider(label="Edit Strength (\"1\" renders from noise)", minimum=0.1, maximum=1.0,
+                                          value=1.0, step=0.01)
                 n_prompt = gr.Textbox(label="Negative Prompt",
                                       value='lowres, bad anatomy, bad hands, cropped, worst quality')
                 with gr.Column():
@@ -585,6 +755,7 @@ with gr.Blocks(
             )
         with gr.Column(scale=75, elem_classes='inner_parent'):
             canvas_state = gr.State(None)
+            render_state = gr.State(None)
             chatbot = gr.Chatbot(label='Omost', scale=1, show_copy_button=True, layout="panel", render=False)
             chatInterface = ChatInterface(
                 fn=chat_fn,
@@ -596,7 +767,7 @@ with gr.Blocks(
                 retry_btn=retry_btn,
                 undo_btn=undo_btn,
                 clear_btn=clear_btn,
-                additional_inputs=[seed, temperature, top_p, max_new_tokens, lora_select],
+                additional_inputs=[seed, temperature, top_p, max_new_tokens, lora_select, lora_weight],
                 examples=examples
             )
 
@@ -604,8 +775,9 @@ with gr.Blocks(
         fn=diffusion_fn, inputs=[
             chatInterface.chatbot, canvas_state,
             num_samples, seed, image_width, image_height, highres_scale,
-            steps, cfg, highres_steps, highres_denoise, n_prompt, model_select, lora_select, lora_weight
-        ], outputs=[chatInterface.chatbot]).then(
+            steps, cfg, highres_steps, highres_denoise, n_prompt, model_select, lora_select, lora_weight,
+            edit_strength, render_state
+        ], outputs=[chatInterface.chatbot, render_state]).then(
         fn=lambda x: x, inputs=[
             chatInterface.chatbot
         ], outputs=[chatInterface.chatbot_state])
@@ -0,0 +1,236 @@
+import gc
+import sys
+import json
+import time
+import pickle
+import random
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+import lib_omost.canvas as omost_canvas
+
+
+# Synthetic workload and CPU benchmark for lib_omost/canvas.py, run with
+#   python -m lib_omost.benchmark --count 1000 --components 1 8 --misspell 0.2
+# Results are printed as one JSON object so they can be compared across commits.
+
+words = ('red', 'old', 'wooden', 'table', 'bright', 'sky', 'green', 'forest', 'small', 'dog', 'running', 'across',
+         'the', 'field', 'under', 'warm', 'light', 'soft', 'shadow', 'glass', 'window', 'city', 'street', 'rain',
+         'woman', 'man', 'wearing', 'a', 'blue', 'coat', 'holding', 'cup', 'of', 'coffee', 'near', 'river', 'stone',
+         'bridge', 'mountain', 'snow', 'cat', 'sleeping', 'on', 'sofa', 'lamp', 'book', 'flowers', 'vase', 'garden')
+
+atmospheres = ('calm and peaceful', 'busy and lively', 'dark and moody', 'warm and cozy', 'cold and lonely')
+styles = ('realistic photography', 'digital painting', 'watercolor', 'cinematic', 'anime illustration')
+qualities = ('high-quality photo', 'masterpiece, best quality', 'detailed, 8k', 'sharp focus')
+
+
+def misspell(value, rng):
+    # One random edit (delete, insert, replace or swap) so that closest_name has to correct the value
+    chars = list(value)
+    i = rng.randrange(len(chars))
+    op = rng.randrange(4)
+
+    if op == 0 and len(chars) > 1:
+        del chars[i]
+    elif op == 1:
+        chars.insert(i, rng.choice('abcdefghijklmnopqrstuvwxyz'))
+    elif op == 2:
+        chars[i] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+    elif i + 1 < len(chars):
+        chars[i], chars[i + 1] = chars[i + 1], chars[i]
+
+    return ''.join(chars)
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(words) for _ in range(length)).capitalize() + '.'
+
+
+def enum_value(options, rng, misspell_rate):
+    value = rng.choice(list(options.keys()))
+    if rng.random() < misspell_rate:
+        value = misspell(value, rng)
+    return value
+
+
+def generate_response(rng, num_components, description_length=12, num_details=3, misspell_rate=0.0):
+    # A bot response in the format of the Omost LLMs, with a fenced canvas program
+    def details():
+        return ',\n'.join(f"        '{sentence(rng, description_length)}'" for _ in range(num_details))
+
+    lines = [
+        'Sure, here is the image composition.',
+        '',
+        '```python',
+        '# Initialize the canvas',
+        'canvas = Canvas()',
+        '',
+        '# Set a global description for the canvas',
+        'canvas.set_global_description(',
+        f"    description='{sentence(rng, description_length)}',",
+        '    detailed_descriptions=[',
+        details(),
+        '    ],',
+        f"    tags='{', '.join(rng.sample(words, 6))}',",
+        f"    HTML_web_color_name='{enum_value(omost_canvas.valid_colors, rng, misspell_rate)}',",
+        ')',
+    ]
+
+    for i in range(num_components):
+        lines += [
+            '',
+            f'# Add component {i}',
+            'canvas.add_local_description(',
+            f"    location='{enum_value(omost_canvas.valid_locations, rng, misspell_rate)}',",
+            f"    offset='{enum_value(omost_canvas.valid_offsets, rng, misspell_rate)}',",
+            f"    area='{enum_value(omost_canvas.valid_areas, rng, misspell_rate)}',",
+            f'    distance_to_viewer={round(rng.uniform(0.5, 10.0), 1)},',
+            f"    description='{sentence(rng, description_length)}',",
+            '    detailed_descriptions=[',
+            details(),
+            '    ],',
+            f"    tags='{', '.join(rng.sample(words, 6))}',",
+            f"    atmosphere='{rng.choice(atmospheres)}',",
+            f"    style='{rng.choice(styles)}',",
+            f"    quality_meta='{rng.choice(qualities)}',",
+            f"    HTML_web_color_name='{enum_value(omost_canvas.valid_colors, rng, misspell_rate)}',",
+            ')',
+        ]
+
+    lines += ['```', '', 'Let me know if you want any changes.']
+    return '\n'.join(lines)
+
+
+def generate_workload(count, min_components=1, max_components=8, description_length=12, num_details=3,
+                      misspell_rate=0.0, seed=0):
+    rng = random.Random(seed)
+    return [generate_response(rng, rng.randint(min_components, max_components), description_length, num_details,
+                              misspell_rate) for _ in range(count)]
+
+
+def summarize(durations, allocations):
+    durations = np.array(durations, dtype=np.float64)
+    total = float(durations.sum())
+    return dict(
+        count=len(durations),
+        total_s=total,
+        throughput_per_s=len(durations) / total if total > 0 else None,
+        mean_ms=float(durations.mean() * 1000) if len(durations) > 0 else None,
+        p50_ms=float(np.percentile(durations, 50) * 1000) if len(durations) > 0 else None,
+        p99_ms=float(np.percentile(durations, 99) * 1000) if len(durations) > 0 else None,
+        alloc_peak_bytes_mean=float(np.mean(allocations)) if len(allocations) > 0 else None,
+        alloc_peak_bytes_max=int(np.max(allocations)) if len(allocations) > 0 else None,
+    )
+
+
+def run_stage(fn, inputs, cold=False):
+    # Times every call, then repeats the calls under tracemalloc for the peak allocation of each call,
+    # since tracing would distort the timings
+    outputs, durations, allocations = [], [], []
+
+    gc.collect()
+    gc.disable()
+    try:
+        for x in inputs:
+            if cold:
+                omost_canvas.closest_name_in_index.cache_clear()
+            start = time.perf_counter()
+            outputs.append(fn(x))
+            durations.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        for x in inputs:
+            if cold:
+                omost_canvas.closest_name_in_index.cache_clear()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            fn(x)
+            allocations.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return outputs, summarize(durations, allocations)
+
+
+def parse_response(response):
+    # Corrections are printed on every call, which would dominate the timings
+    stdout = sys.stdout
+    sys.stdout = None
+    try:
+        return omost_canvas.Canvas.from_bot_response(response)
+    finally:
+        sys.stdout = stdout
+
+
+def process_canvas(canvas):
+    # process sorts the components in place, so it works on a shallow copy to keep every run identical
+    copied = omost_canvas.Canvas()
+    copied.__dict__.update(canvas.__dict__)
+    copied.components = list(canvas.components)
+    return copied.process()
+
+
+def run_benchmark(count=1000, min_components=1, max_components=8, description_length=12, num_details=3,
+                  misspell_rate=0.2, seed=0, cold=False, batch=False):
+    responses = generate_workload(count, min_components, max_components, description_length, num_details,
+                                  misspell_rate, seed)
+
+    stages = {}
+    canvases, stages['from_bot_response'] = run_stage(parse_response, responses, cold=cold)
+    outputs, stages['process'] = run_stage(process_canvas, canvases)
+    serialized, stages['serialize'] = run_stage(pickle.dumps, outputs)
+    _, stages['deserialize'] = run_stage(pickle.loads, serialized)
+
+    if batch:
+        _, stages['process_canvases'] = run_stage(omost_canvas.process_canvases, [canvases])
+        stages['process_canvases']['canvases_per_s'] = count / stages['process_canvases']['total_s']
+
+    return dict(
+        config=dict(count=count, min_components=min_components, max_components=max_components,
+                    description_length=description_length, num_details=num_details, misspell_rate=misspell_rate,
+                    seed=seed, cold=cold, batch=batch),
+        environment=dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine()),
+        workload=dict(
+            response_bytes_mean=float(np.mean([len(x) for x in responses])),
+            components_mean=float(np.mean([len(x.components) for x in canvases])),
+            serialized_bytes_mean=float(np.mean([len(x) for x in serialized])),
+        ),
+        stages=stages,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark canvas parsing, processing and serialization on CPU.')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--components', type=int, nargs=2, default=[1, 8], metavar=('MIN', 'MAX'))
+    parser.add_argument('--description_length', type=int, default=12)
+    parser.add_argument('--num_details', type=int, default=3)
+    parser.add_argument('--misspell', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    # Clears the closest_name memo before every response
+    parser.add_argument('--cold', action='store_true')
+    # Also time process_canvases over the whole workload as one batch
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    result = run_benchmark(count=args.count, min_components=args.components[0], max_components=args.components[1],
+                           description_length=args.description_length, num_details=args.num_details,
+                           misspell_rate=args.misspell, seed=args.seed, cold=args.cold, batch=args.batch)
+    text = json.dumps(result, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    print(text)
+    return
+
+
+if __name__ == '__main__':
+    main()
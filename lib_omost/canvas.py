@@ -1,7 +1,14 @@
 import re
+import ast
+import keyword
 import difflib
+import hashlib
+import functools
+import threading
 import numpy as np
 
+from collections import OrderedDict
+
 system_prompt = r'''You are a helpful AI assistant to compose images using the below python class `Canvas`:
 
 ```python
@@ -104,12 +111,66 @@ valid_areas = {  # w, h in 90*90
 }
 
 
+closest_name_indices = {}
+
+
+def build_closest_name_index(options):
+    # Character counts of all option names. The multiset intersection with the input gives difflib's quick_ratio,
+    # which is an upper bound of ratio, so candidates can be scored best-bound-first and pruned exactly.
+    names = list(options.keys())
+    columns = {c: i for i, c in enumerate(sorted(set(''.join(names))))}
+    counts = np.zeros((len(names), len(columns)), dtype=np.int64)
+
+    for i, name in enumerate(names):
+        for c in name:
+            counts[i, columns[c]] += 1
+
+    lengths = np.array([len(name) for name in names], dtype=np.int64)
+    return dict(size=len(options), names=names, name_set=set(names), columns=columns, counts=counts, lengths=lengths)
+
+
+@functools.lru_cache(maxsize=65536)
+def closest_name_in_index(input_str, index_id, cutoff=0.5):
+    # Same result as difflib.get_close_matches(input_str, names, n=1, cutoff=cutoff), i.e. the largest (ratio, name)
+    index = closest_name_indices[index_id]
+
+    if input_str in index['name_set']:
+        return input_str
+
+    query = np.zeros(len(index['columns']), dtype=np.int64)
+    for c in input_str:
+        if c in index['columns']:
+            query[index['columns'][c]] += 1
+
+    matches = np.minimum(index['counts'], query[None]).sum(axis=1)
+    bounds = [2.0 * int(m) / int(l + len(input_str)) if l + len(input_str) > 0 else 1.0
+              for m, l in zip(matches, index['lengths'])]
+
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq2(input_str)
+    best = None
+
+    for bound, name in sorted(zip(bounds, index['names']), reverse=True):
+        if bound < cutoff or (best is not None and bound < best[0]):
+            break
+        matcher.set_seq1(name)
+        ratio = matcher.ratio()
+        if ratio >= cutoff and (best is None or (ratio, name) > best):
+            best = ratio, name
+
+    return None if best is None else best[1]
+
+
 def closest_name(input_str, options):
     input_str = input_str.lower()
 
-    closest_match = difflib.get_close_matches(input_str, list(options.keys()), n=1, cutoff=0.5)
-    assert isinstance(closest_match, list) and len(closest_match) > 0, f'The value [{input_str}] is not valid!'
-    result = closest_match[0]
+    index = closest_name_indices.get(id(options), None)
+    if index is None or index['size'] != len(options):
+        closest_name_indices[id(options)] = build_closest_name_index(options)
+        closest_name_in_index.cache_clear()
+
+    result = closest_name_in_index(input_str, id(options))
+    assert result is not None, f'The value [{input_str}] is not valid!'
 
     if result != input_str:
         print(f'Automatically corrected [{input_str}] -> [{result}].')
@@ -127,6 +188,262 @@ def binary_nonzero_positions(n, offset=0):
     return positions
 
 
+canvas_methods = ['set_global_description', 'add_local_description']
+
+# Canvas programs are interpreted without exec: only `x = Canvas()` and calls of canvas_methods with literal
+# arguments are accepted, so untrusted LLM output cannot run anything else.
+# Most programs only use plain strings, numbers and lists of strings, and are matched with regular expressions
+# (fast_statement_pattern); anything else goes through the slower `ast` based parser.
+
+fast_string = r"""'[^'\\\n]*'|"[^"\\\n]*\""""
+fast_value = rf"""{fast_string}|\[\s*(?:(?:{fast_string})\s*,\s*)*(?:(?:{fast_string})\s*)?\]""" \
+             r"""|[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?|True|False|None"""
+fast_argument = rf"""(?:[A-Za-z_]\w*\s*=\s*)?(?:{fast_value})"""
+fast_statement_pattern = re.compile(
+    rf"""(?:[ \t]*(?:#[^\n]*)?\n)*"""
+    rf"""(?:(?P<target>[A-Za-z_]\w*)[ \t]*=[ \t]*Canvas\(\)"""
+    rf"""|(?P<var>[A-Za-z_]\w*)\.(?P<method>[A-Za-z_]\w*)\((?P<args>\s*(?:{fast_argument}\s*,\s*)*(?:{fast_argument}\s*)?)\))"""
+    rf"""[ \t]*(?:#[^\n]*)?(?:\n|\Z)""")
+fast_argument_pattern = re.compile(rf"""(?:([A-Za-z_]\w*)\s*=\s*)?({fast_value})""")
+fast_list_item_pattern = re.compile(r"""'([^'\\\n]*)'|"([^"\\\n]*)\"""")
+fast_blank_pattern = re.compile(r"""(?:\s|#[^\n]*)*""")
+fast_constants = {'True': True, 'False': False, 'None': None}
+
+
+def fast_literal(text):
+    if text[0] in '\'"':
+        return text[1:-1]
+    if text[0] == '[':
+        return [a or b for a, b in fast_list_item_pattern.findall(text)]
+    if text in fast_constants:
+        return fast_constants[text]
+    if '.' in text or 'e' in text or 'E' in text:
+        return float(text)
+    return int(text)
+
+
+def parse_canvas_code_fast(code_content: str):
+    # Returns a list of (lineno, var, method, args, kwargs), or None if the program needs the ast parser
+    calls = []
+    position = 0
+    lineno = 1
+
+    while position < len(code_content):
+        matched = fast_statement_pattern.match(code_content, position)
+        if matched is None:
+            break
+
+        start = matched.start('target') if matched.group('target') is not None else matched.start('var')
+        lineno += code_content.count('\n', position, start)
+        position = matched.end()
+
+        if matched.group('target') is not None:
+            calls.append((lineno, matched.group('target'), None, [], {}))
+        else:
+            args = []
+            kwargs = {}
+
+            for key, value in fast_argument_pattern.findall(matched.group('args')):
+                if key == '':
+                    if len(kwargs) > 0:
+                        return None
+                elif key in kwargs or keyword.iskeyword(key):
+                    return None
+
+                # e.g. integers over the int() digit limit, the ast parser reports them with their line
+                try:
+                    literal = fast_literal(value)
+                except ValueError:
+                    return None
+
+                if key == '':
+                    args.append(literal)
+                else:
+                    kwargs[key] = literal
+
+            calls.append((lineno, matched.group('var'), matched.group('method'), args, kwargs))
+
+        lineno += code_content.count('\n', start, position)
+
+    if fast_blank_pattern.fullmatch(code_content, position) is None:
+        return None
+
+    return calls
+
+
+def parse_canvas_code_ast(code_content: str):
+    # Returns a list of (lineno, var, method, args, kwargs) and a list of (lineno, error)
+    try:
+        tree = ast.parse(code_content)
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        raise AssertionError(f'Code block is not valid Python: {e}')
+
+    calls = []
+    errors = []
+
+    for node in tree.body:
+        try:
+            if isinstance(node, ast.Pass) or (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)):
+                continue
+
+            if isinstance(node, ast.Assign):
+                assert len(node.targets) == 1 and isinstance(node.targets[0], ast.Name), \
+                    'Only assignments to a single name are allowed!'
+                call = node.value
+                assert isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == 'Canvas' \
+                       and len(call.args) == 0 and len(call.keywords) == 0, 'Only `Canvas()` can be assigned!'
+                calls.append((node.lineno, node.targets[0].id, None, [], {}))
+                continue
+
+            assert isinstance(node, ast.Expr) and isinstance(node.value, ast.Call), 'Only canvas calls are allowed!'
+            call = node.value
+            assert isinstance(call.func, ast.Attribute) and isinstance(call.func.value, ast.Name), \
+                'Only canvas calls are allowed!'
+            assert all(k.arg is not None for k in call.keywords), 'Keyword unpacking is not allowed!'
+
+            try:
+                args = [ast.literal_eval(x) for x in call.args]
+                kwargs = {k.arg: ast.literal_eval(k.value) for k in call.keywords}
+            except (ValueError, TypeError, SyntaxError, RecursionError, MemoryError):
+                raise AssertionError('Arguments must be literals!')
+
+            calls.append((node.lineno, call.func.value.id, call.func.attr, args, kwargs))
+        except AssertionError as e:
+            errors.append((node.lineno, str(e)))
+
+    return calls, errors
+
+
+def run_canvas_calls(calls, local_vars):
+    # Applies parsed calls to the canvases in local_vars, returns a list of (lineno, error)
+    errors = []
+
+    for lineno, name, method_name, args, kwargs in calls:
+        try:
+            if method_name is None:
+                local_vars[name] = Canvas()
+                continue
+
+            assert method_name in canvas_methods, f'Method [{method_name}] is not allowed!'
+            assert name in local_vars, f'Variable [{name}] is not defined!'
+
+            try:
+                getattr(local_vars[name], method_name)(*args, **kwargs)
+            except (TypeError, AttributeError, ValueError) as e:
+                raise AssertionError(f'Invalid arguments for [{method_name}]: {e}')
+        except AssertionError as e:
+            errors.append((lineno, str(e)))
+
+    return errors
+
+
+def interpret_canvas_code(code_content: str):
+    calls = parse_canvas_code_fast(code_content)
+    errors = []
+
+    if calls is None:
+        calls, errors = parse_canvas_code_ast(code_content)
+
+    local_vars = {}
+    errors += run_canvas_calls(calls, local_vars)
+
+    assert len(errors) == 0, '\n'.join(f'Line {lineno}: {e}' for lineno, e in sorted(errors))
+    return local_vars
+
+
+class CanvasStreamParser:
+    # Consumes a bot response while it is being streamed and runs every canvas statement as soon as it is
+    # complete, i.e. when its closing parenthesis arrives. feed() returns the conditions (prefixes and suffixes,
+    # as in Canvas.process) of the descriptions completed by the new text, so that they can be encoded early.
+    # Invalid statements are skipped here; Canvas.from_bot_response on the full response reports them.
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = None
+        self.statement_start = None
+        self.depth = 0
+        self.quote = None
+        self.escaped = False
+        self.comment = False
+        self.finished = False
+        self.local_vars = {}
+        return
+
+    def feed(self, text: str):
+        self.buffer += text
+        conditions = []
+
+        if self.position is None:
+            fence = self.buffer.find('```python\n')
+            if fence < 0:
+                return conditions
+            self.position = self.statement_start = fence + len('```python\n')
+
+        while not self.finished and self.position < len(self.buffer):
+            c = self.buffer[self.position]
+            self.position += 1
+
+            if self.quote is not None:
+                if self.escaped:
+                    self.escaped = False
+                elif c == '\\':
+                    self.escaped = True
+                elif c == self.quote or c == '\n':
+                    self.quote = None
+            elif self.comment and c != '\n':
+                continue
+            elif c in '\'"':
+                self.quote = c
+            elif c == '#':
+                self.comment = True
+            elif c in '([{':
+                self.depth += 1
+            elif c in ')]}':
+                self.depth -= 1
+                if self.depth == 0 and c == ')':
+                    conditions += self.run_statement()
+            elif c == '\n':
+                self.comment = False
+                if self.depth == 0:
+                    conditions += self.run_statement()
+            elif c == '`' and self.depth == 0 and self.buffer[self.statement_start:self.position].strip() == '`':
+                self.finished = True
+
+        return conditions
+
+    def run_statement(self):
+        statement = self.buffer[self.statement_start:self.position].strip()
+        self.statement_start = self.position
+
+        if statement == '' or statement.startswith('#'):
+            return []
+
+        conditions = []
+
+        # Early encoding is only an optimization, whatever a statement does must not stop the chat stream
+        try:
+            calls = parse_canvas_code_fast(statement)
+            if calls is None:
+                calls, errors = parse_canvas_code_ast(statement)
+
+            for call in calls:
+                if len(run_canvas_calls([call], self.local_vars)) > 0:
+                    continue
+
+                lineno, name, method_name, args, kwargs = call
+                canvas = self.local_vars[name]
+
+                if method_name == 'set_global_description':
+                    conditions.append(dict(prefixes=canvas.prefixes, suffixes=canvas.suffixes))
+                elif method_name == 'add_local_description':
+                    component = canvas.components[-1]
+                    conditions.append(dict(prefixes=component['prefixes'], suffixes=component['suffixes']))
+        except Exception:
+            return []
+
+        return conditions
+
+
 class Canvas:
     @staticmethod
     def from_bot_response(response: str):
@@ -134,8 +451,7 @@ class Canvas:
         assert matched, 'Response does not contain codes!'
         code_content = matched.group(1)
         assert 'canvas = Canvas()' in code_content, 'Code block must include valid canvas var!'
-        local_vars = {'Canvas': Canvas}
-        exec(code_content, {}, local_vars)
+        local_vars = interpret_canvas_code(code_content)
         canvas = local_vars.get('canvas', None)
         assert isinstance(canvas, Canvas), 'Code block must produce valid canvas var!'
         return canvas
@@ -229,15 +545,12 @@ class Canvas:
         # compute conditions
 
         bag_of_conditions = [
-            dict(mask=np.ones(shape=(90, 90), dtype=np.float32), prefixes=self.prefixes, suffixes=self.suffixes)
+            dict(mask=Region(), prefixes=self.prefixes, suffixes=self.suffixes)
         ]
 
         for i, component in enumerate(self.components):
-            a, b, c, d = component['rect']
-            m = np.zeros(shape=(90, 90), dtype=np.float32)
-            m[a:b, c:d] = 1.0
             bag_of_conditions.append(dict(
-                mask=m,
+                mask=Region(component['rect']),
                 prefixes=component['prefixes'],
                 suffixes=component['suffixes']
             ))
@@ -245,4 +558,278 @@ class Canvas:
         return dict(
             initial_latent=initial_latent,
             bag_of_conditions=bag_of_conditions,
+            canvas=self,
         )
+
+
+def nearest_exact_index(input_size, output_size):
+    # Source indices of torch's 'nearest-exact' interpolation, computed in float32 like torch does
+    scale = np.float32(input_size) / np.float32(output_size)
+    index = np.floor((np.arange(output_size, dtype=np.float32) + np.float32(0.5)) * scale).astype(np.int64)
+    return np.minimum(index, input_size - 1)
+
+
+class Region:
+    # Mask of one condition: a rect (a, b, c, d) of rows [a, b) and columns [c, d) in 90*90, or a dense
+    # 90*90 mask that overrides the rect. materialize(H, W) gives the float32 mask at any resolution, equal
+    # to the 'nearest-exact' interpolation of the 90*90 mask, and caches it. The caches are not pickled.
+
+    __slots__ = ['rect', 'mask', 'cache']
+
+    def __init__(self, rect=(0, 90, 0, 90), mask=None):
+        self.rect = tuple(int(x) for x in rect)
+        self.mask = mask
+        self.cache = {}
+        return
+
+    def materialize(self, height=90, width=90):
+        if (height, width) not in self.cache:
+            rows = nearest_exact_index(90, height)
+            columns = nearest_exact_index(90, width)
+
+            if self.mask is not None:
+                m = np.asarray(self.mask, dtype=np.float32)[rows[:, None], columns[None, :]]
+            else:
+                m = rect_masks(self.rect, rows, columns).astype(np.float32)
+
+            self.cache[(height, width)] = m
+        return self.cache[(height, width)]
+
+    def __array__(self, dtype=None, copy=None):
+        m = self.materialize()
+        return m if dtype is None else m.astype(dtype)
+
+    def __getstate__(self):
+        return self.rect, self.mask
+
+    def __setstate__(self, state):
+        self.rect, self.mask = state
+        self.cache = {}
+        return
+
+    def __repr__(self):
+        return f'Region(rect={self.rect}{", mask=..." if self.mask is not None else ""})'
+
+
+def diff_canvases(old, new):
+    # Matches the components of two canvases, e.g. of two chat turns. Identical components are unchanged,
+    # the remaining ones are paired by description as modified. Indices refer to old.components and
+    # new.components in their current order (Canvas.process sorts them).
+
+    def component_key(x):
+        return (tuple(x['rect']), tuple(np.asarray(x['color']).flatten().tolist()), x['distance_to_viewer'],
+                tuple(x['prefixes']), tuple(x['suffixes']))
+
+    unchanged, modified, added = [], [], []
+    old_by_key, old_by_description = {}, {}
+    matched = set()
+
+    for i, x in enumerate(old.components):
+        old_by_key.setdefault(component_key(x), []).append(i)
+        old_by_description.setdefault(x['prefixes'][-1], []).append(i)
+
+    unmatched = []
+
+    for j, x in enumerate(new.components):
+        candidates = old_by_key.get(component_key(x), [])
+        if len(candidates) > 0:
+            i = candidates.pop(0)
+            matched.add(i)
+            unchanged.append((i, j))
+        else:
+            unmatched.append(j)
+
+    for j in unmatched:
+        candidates = [i for i in old_by_description.get(new.components[j]['prefixes'][-1], []) if i not in matched]
+        if len(candidates) > 0:
+            matched.add(candidates[0])
+            modified.append((candidates[0], j))
+        else:
+            added.append(j)
+
+    removed = [i for i in range(len(old.components)) if i not in matched]
+
+    global_changed = (old.prefixes != new.prefixes or old.suffixes != new.suffixes or
+                      not np.array_equal(old.color, new.color))
+
+    return dict(
+        unchanged=unchanged,
+        modified=sorted(modified, key=lambda x: x[1]),
+        added=added,
+        removed=removed,
+        global_changed=global_changed,
+    )
+
+
+def rect_masks(rects, rows=None, columns=None):
+    # Masks of shape rects.shape[:-1] + (len(rows), len(columns)) for rects given as (a, b, c, d) in 90*90,
+    # sampled at the given row and column coordinates (all of the 90*90 grid by default)
+    rects = np.asarray(rects)
+    rows = np.arange(90) if rows is None else np.asarray(rows)
+    columns = np.arange(90) if columns is None else np.asarray(columns)
+    a, b, c, d = [rects[..., i, None, None] for i in range(4)]
+    return (rows[:, None] >= a) & (rows[:, None] < b) & (columns[None, :] >= c) & (columns[None, :] < d)
+
+
+def process_canvases(canvases, return_masks=False):
+    # Batch version of Canvas.process for many canvases, vectorized over the canvases.
+    # Components are packed into (N, K_max) tables sorted like Canvas.process sorts them; slots past counts[i]
+    # hold empty rects. order[i, k] is the index into canvases[i].components of the k-th sorted component,
+    # which is left unsorted. Masks are only materialized with return_masks, otherwise use rect_masks(rects).
+
+    n = len(canvases)
+    counts = np.array([len(canvas.components) for canvas in canvases], dtype=np.int64).reshape(n)
+    k_max = int(counts.max()) if n > 0 else 0
+    components = [component for canvas in canvases for component in canvas.components]
+    slots = np.arange(k_max)[None] < counts[:, None]
+
+    rects = np.zeros(shape=(n, k_max, 4), dtype=np.int32)
+    colors = np.zeros(shape=(n, k_max, 3), dtype=np.uint8)
+    distances = np.full(shape=(n, k_max), fill_value=-np.inf)
+    global_colors = np.zeros(shape=(n, 1, 1, 3), dtype=np.uint8)
+
+    if n > 0:
+        global_colors[:] = np.concatenate([canvas.color for canvas in canvases]).reshape(n, 1, 1, 3)
+
+    if len(components) > 0:
+        rects[slots] = [component['rect'] for component in components]
+        colors[slots] = np.concatenate([component['color'] for component in components]).reshape(-1, 3)
+        distances[slots] = [component['distance_to_viewer'] for component in components]
+
+    # sort components, stable and far to near as in Canvas.process
+    order = np.argsort(-distances, axis=1, kind='stable')
+    rects = np.take_along_axis(rects, order[..., None], axis=1)
+    colors = np.take_along_axis(colors, order[..., None], axis=1)
+
+    # compute initial latent on the grid of cells cut by all rect edges, where every pixel of a cell sees the
+    # same components, then expand the cells to 90*90. The arithmetic is the same as in Canvas.process.
+    row_edges = np.unique(np.concatenate([[0, 90], rects[..., 0].ravel(), rects[..., 1].ravel()]))
+    column_edges = np.unique(np.concatenate([[0, 90], rects[..., 2].ravel(), rects[..., 3].ravel()]))
+    initial_latent = np.zeros(shape=(n, len(row_edges) - 1, len(column_edges) - 1, 3), dtype=np.float32)
+    initial_latent += global_colors
+
+    for k in range(k_max):
+        i = np.flatnonzero(slots[:, k])
+        m = rect_masks(rects[i, k], row_edges[:-1], column_edges[:-1])[..., None]
+        blended = 0.7 * colors[i, k, None, None, :] + 0.3 * initial_latent[i]
+        initial_latent[i] = np.where(m, blended, initial_latent[i])
+
+    cells = initial_latent.clip(0, 255).astype(np.uint8)
+    cells = np.take(cells, np.repeat(np.arange(len(column_edges) - 1), np.diff(column_edges)), axis=2)
+    initial_latent = np.empty(shape=(n, 90, 90, 3), dtype=np.uint8)
+
+    for r in range(len(row_edges) - 1):
+        initial_latent[:, row_edges[r]:row_edges[r + 1]] = cells[:, r, None]
+
+    result = dict(
+        initial_latent=initial_latent,
+        rects=rects,
+        colors=colors,
+        counts=counts,
+        order=order,
+    )
+
+    if return_masks:
+        result['masks'] = rect_masks(rects).astype(np.float32)
+
+    return result
+
+
+def optimize_bag_of_conditions(canvas_outputs, height, width, merge_duplicates=True, cull_occluded=True):
+    # Optional pass between Canvas.process and all_conds_from_canvas that removes regions before encoding.
+    # height and width are the latent size. Duplicates (same mask and prompts) are merged into their nearest
+    # copy, and regions whose mask is fully covered by nearer regions at (height, width), or empty there, are
+    # dropped. Each region normally attends within its whole mask, so this slightly changes the result and is
+    # off by default. The global condition is always kept. Returns new outputs, the input is not modified.
+
+    bag_of_conditions = canvas_outputs['bag_of_conditions']
+    regions = [x['mask'] if isinstance(x['mask'], Region) else Region(mask=x['mask']) for x in bag_of_conditions]
+    keep = [True] * len(bag_of_conditions)
+
+    # items are sorted far to near, so nearer regions come later
+    if merge_duplicates:
+        seen = set()
+        for i in reversed(range(1, len(bag_of_conditions))):
+            item, region = bag_of_conditions[i], regions[i]
+            mask_bytes = None if region.mask is None else np.asarray(region.mask, dtype=np.float32).tobytes()
+            key = (region.rect, mask_bytes, tuple(item['prefixes']), tuple(item['suffixes']))
+            if key in seen:
+                keep[i] = False
+                print(f'Merged duplicate region [{item["prefixes"][-1]}].')
+            seen.add(key)
+
+    if cull_occluded:
+        covered = np.zeros(shape=(height, width), dtype=bool)
+        for i in reversed(range(1, len(bag_of_conditions))):
+            if not keep[i]:
+                continue
+            m = regions[i].materialize(height, width) > 0.5
+            if not (m & ~covered).any():
+                keep[i] = False
+                print(f'Removed occluded region [{bag_of_conditions[i]["prefixes"][-1]}].')
+            covered |= m
+
+    removed = len(keep) - sum(keep)
+    if removed > 0:
+        print(f'Region optimization removed {removed} of {len(keep) - 1} regions.')
+
+    return dict(canvas_outputs, bag_of_conditions=[x for x, k in zip(bag_of_conditions, keep) if k])
+
+
+def canvas_program_key(response: str):
+    # Hash of the canvas code in a bot response, ignoring blank lines, comment lines and trailing whitespace.
+    # Code with triple-quoted strings is hashed as is, since lines inside them are part of the values.
+    matched = re.search(r'```python\n(.*?)\n```', response, re.DOTALL)
+    if not matched:
+        return None
+
+    code_content = matched.group(1)
+
+    if "'''" not in code_content and '"""' not in code_content:
+        lines = [line.rstrip() for line in code_content.splitlines()]
+        code_content = '\n'.join(line for line in lines if line.strip() != '' and not line.lstrip().startswith('#'))
+
+    return hashlib.sha256(code_content.encode('utf-8')).hexdigest()
+
+
+class CanvasOutputsCache:
+    # Bounded LRU of Canvas.process outputs keyed by canvas_program_key, shared by all sessions of a process.
+    # Cached outputs are returned as is and must be treated as read-only. Invalid programs are not cached.
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        return
+
+    def process_bot_response(self, response: str):
+        key = canvas_program_key(response) if isinstance(response, str) else None
+
+        with self.lock:
+            if key is not None and key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        canvas_outputs = Canvas.from_bot_response(response).process()
+
+        if key is not None and self.max_entries > 0:
+            with self.lock:
+                self.entries[key] = canvas_outputs
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        return canvas_outputs
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), max_entries=self.max_entries)
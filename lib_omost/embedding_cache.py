@@ -0,0 +1,108 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+import torch
+
+from collections import OrderedDict
+from safetensors.torch import save_file, load_file
+
+
+class EmbeddingCache:
+    # Content-addressed cache of text embeddings for single 77-token chunks.
+    # The memory tier is an LRU bounded by max_bytes and holds CPU tensors.
+    # The optional disk tier writes one safetensors file per chunk into disk_dir;
+    # files are written atomically so several worker processes can share the same folder.
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        return
+
+    @staticmethod
+    def make_key(model_identity, lora_identity, lora_scale, ids_t1, ids_t2):
+        content = json.dumps([str(model_identity), str(lora_identity), lora_scale,
+                              torch.as_tensor(ids_t1).flatten().tolist(), torch.as_tensor(ids_t2).flatten().tolist()])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.safetensors')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.disk_dir is not None and os.path.exists(self.disk_path(key)):
+            try:
+                tensors = load_file(self.disk_path(key))
+                value = tensors['cond'], tensors['pooler']
+            except Exception as e:
+                print('Failed to read cached embedding:', e)
+            else:
+                with self.lock:
+                    self.disk_hits += 1
+                self.put(key, *value, write_to_disk=False)
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, cond, pooler, write_to_disk=True):
+        # Always a copy: on CPU, .to('cpu') of a row of the batch would keep the whole batch's storage alive
+        cond = cond.detach().to('cpu', copy=True).contiguous()
+        pooler = pooler.detach().to('cpu', copy=True).contiguous()
+        size = cond.numel() * cond.element_size() + pooler.numel() * pooler.element_size()
+
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = cond, pooler
+                self.current_bytes += size
+
+                while self.current_bytes > self.max_bytes:
+                    _, (old_cond, old_pooler) = self.entries.popitem(last=False)
+                    self.current_bytes -= old_cond.numel() * old_cond.element_size()
+                    self.current_bytes -= old_pooler.numel() * old_pooler.element_size()
+
+        if write_to_disk and self.disk_dir is not None and not os.path.exists(self.disk_path(key)):
+            path = self.disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            try:
+                save_file({'cond': cond, 'pooler': pooler}, temp_path)
+                os.replace(temp_path, path)
+            except Exception as e:
+                print('Failed to write cached embedding:', e)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+        return
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                entries=len(self.entries),
+                bytes=self.current_bytes,
+                max_bytes=self.max_bytes,
+            )
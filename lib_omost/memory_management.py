@@ -1,15 +1,24 @@
-import torch
-from contextlib import contextmanager
 import gc
+import json
+import time
+import torch
+import weakref
+import itertools
+import threading
 
-high_vram = False
-gpu = torch.device('cuda')
-cpu = torch.device('cpu')
+from collections import OrderedDict
+from contextlib import contextmanager
 
-torch.zeros((1, 1)).to(gpu, torch.float32)
-torch.cuda.empty_cache()
+# The compute device is only created on first use, so importing this module never initializes CUDA.
+# `gpu` and `manager` are still available as module attributes and are created when first accessed.
 
-models_in_gpu = []
+cpu = torch.device('cpu')
+device_spec = 'cuda'
+budget_bytes = 0
+transfer_log_path = None
+device = None
+residency_manager = None
+model_names = weakref.WeakKeyDictionary()
 
 
 @contextmanager
@@ -26,45 +35,685 @@ def movable_bnb_model(m):
     return
 
 
+def model_bytes(m):
+    return sum(t.numel() * t.element_size() for t in itertools.chain(m.parameters(), m.buffers()))
+
+
+def model_name(m):
+    # Models without a name from name_models are counted under their class name
+    return model_names.get(m, m.__class__.__name__)
+
+
+def move_model(m, device, non_blocking=False):
+    with movable_bnb_model(m):
+        # Using `to_empty` to avoid copying meta tensors directly to GPU
+        m.to(device, non_blocking=non_blocking)
+    return
+
+
+def pin_model(m):
+    # Page-locked host memory lets host to device copies run asynchronously
+    if getattr(m, 'quantization_method', None) is not None:
+        return
+    for t in itertools.chain(m.parameters(), m.buffers()):
+        if t.device.type == 'cpu' and not t.is_pinned():
+            t.data = t.data.pin_memory()
+    return
+
+
+class ModelResidencyManager:
+    # Keeps models on the compute device within budget_bytes. Models are only moved back to the offload device
+    # when loading the requested ones would exceed the budget, least recently used first. Requested models are
+    # always loaded, so a budget of 0 keeps only the models of the last request, and None never unloads.
+    # move_fn, size_fn and empty_cache_fn can be replaced, e.g. to run with a fake device.
+    # Every transfer is counted per model name in stats(), and written as one JSON line to log_path when set.
+    # prefetch() starts loading models on a background thread while the current stage computes, on a side CUDA
+    # stream from pinned host memory when the device is a GPU. It never unloads the models of the last load(), so
+    # it is skipped when those and the prefetched models do not fit the budget together, e.g. always with a budget
+    # of 0. load() only waits for the prefetches of the models it needs: the worker only takes the lock to update
+    # the bookkeeping, and the models it moves are in prefetching until they are done.
+
+    def __init__(self, device, offload_device, budget_bytes=0, move_fn=move_model, size_fn=model_bytes,
+                 empty_cache_fn=None, pin_memory=False, name_fn=model_name, log_path=None):
+        self.device = device
+        self.offload_device = offload_device
+        self.budget_bytes = budget_bytes
+        self.move_fn = move_fn
+        self.size_fn = size_fn
+        self.name_fn = name_fn
+        self.empty_cache_fn = empty_cache_fn
+        self.pin_memory = pin_memory
+        self.use_streams = isinstance(device, torch.device) and device.type == 'cuda'
+        self.stream = None
+        self.lock = threading.RLock()
+        self.resident = OrderedDict()
+        self.active = []
+        self.prefetching = {}
+        self.incoming = {}
+        self.events = {}
+        self.log_file = None
+        self.set_log(log_path)
+        self.reset_stats()
+        return
+
+    def reset_stats(self):
+        with self.lock:
+            self.prefetches = 0
+            self.seconds_waiting = 0.0
+            self.loads = 0
+            self.unloads = 0
+            self.bytes_loaded = 0
+            self.bytes_unloaded = 0
+            self.seconds_loading = 0.0
+            self.seconds_unloading = 0.0
+            self.model_stats = {}
+        return
+
+    def set_log(self, log_path):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+            self.log_file = open(log_path, 'a') if log_path is not None else None
+        return
+
+    def record(self, event, m, size, seconds):
+        # event is 'load', 'prefetch' (a load on the background thread) or 'unload', called with the lock held
+        name = self.name_fn(m)
+        if name not in self.model_stats:
+            self.model_stats[name] = dict(loads=0, unloads=0, prefetches=0, bytes_loaded=0, bytes_unloaded=0,
+                                          seconds_loading=0.0, seconds_unloading=0.0)
+        model_stats = self.model_stats[name]
+
+        if event == 'unload':
+            self.unloads += 1
+            self.bytes_unloaded += size
+            self.seconds_unloading += seconds
+            model_stats['unloads'] += 1
+            model_stats['bytes_unloaded'] += size
+            model_stats['seconds_unloading'] += seconds
+        else:
+            self.loads += 1
+            self.bytes_loaded += size
+            self.seconds_loading += seconds
+            model_stats['loads'] += 1
+            model_stats['bytes_loaded'] += size
+            model_stats['seconds_loading'] += seconds
+            if event == 'prefetch':
+                model_stats['prefetches'] += 1
+
+        if self.log_file is not None:
+            self.log_file.write(json.dumps(dict(
+                time=time.time(),
+                event=event,
+                model=name,
+                bytes=size,
+                seconds=seconds,
+                device=str(self.offload_device if event == 'unload' else self.device),
+                resident_bytes=self.resident_bytes(),
+            )) + '\n')
+            self.log_file.flush()
+        return
+
+    def resident_bytes(self):
+        return sum(self.resident.values())
+
+    def load(self, models):
+        models = list(dict.fromkeys(models))
+        self.wait_for_prefetch(models)
+
+        with self.lock:
+            self.active = models
+            self.load_unlocked(models, protected=models)
+        return
+
+    def prefetch(self, models):
+        # prefetching is shared with the worker threads, it is only read or changed with the lock held
+        with self.lock:
+            models = [m for m in dict.fromkeys(models) if m not in self.resident and m not in self.prefetching]
+            if len(models) == 0:
+                return
+
+            if self.budget_bytes is not None:
+                active_bytes = sum(self.resident.get(m, 0) for m in self.active)
+                incoming_bytes = sum(self.incoming.values()) + sum(self.size_fn(m) for m in models)
+                if active_bytes + incoming_bytes > self.budget_bytes:
+                    return
+
+            ready = None
+            if self.use_streams:
+                ready = torch.cuda.Event()
+                ready.record(torch.cuda.current_stream(self.device))
+
+            thread = threading.Thread(target=self.prefetch_worker, args=(models, ready), daemon=True)
+            for m in models:
+                self.prefetching[m] = thread
+            thread.start()
+        return
+
+    def prefetch_worker(self, models, ready):
+        thread = threading.current_thread()
+        evicted = []
+
+        try:
+            with self.lock:
+                sizes = {m: self.size_fn(m) for m in models}
+                models_to_unload = self.models_over_budget(sum(sizes.values()), protected=self.active + models)
+                for m in models_to_unload:
+                    evicted.append((m, self.resident.pop(m)))
+                    self.events.pop(m, None)
+                    self.prefetching[m] = thread
+                self.incoming.update(sizes)
+                if self.use_streams and self.stream is None:
+                    self.stream = torch.cuda.Stream(self.device)
+
+            if len(evicted) > 0:
+                # weights may still be read by queued kernels
+                if self.use_streams:
+                    torch.cuda.synchronize(self.device)
+
+                for m, size in evicted:
+                    start = time.perf_counter()
+                    self.move_fn(m, self.offload_device, False)
+                    with self.lock:
+                        self.record('unload', m, size, time.perf_counter() - start)
+                        self.prefetching.pop(m, None)
+                    print('Unload to CPU:', self.name_fn(m))
+
+                if self.empty_cache_fn is not None:
+                    self.empty_cache_fn()
+
+            # Pinned here rather than on unload, so only the models that are actually prefetched pay for it
+            if self.pin_memory:
+                for m in models:
+                    pin_model(m)
+
+            for m in models:
+                # Asynchronous copies are only timed until they are queued
+                start = time.perf_counter()
+                event = None
+                if self.use_streams:
+                    self.stream.wait_event(ready)
+                    with torch.cuda.stream(self.stream):
+                        self.move_fn(m, self.device, True)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    self.move_fn(m, self.device, False)
+
+                with self.lock:
+                    self.resident[m] = self.incoming.pop(m)
+                    if event is not None:
+                        self.events[m] = event
+                    self.record('prefetch', m, self.resident[m], time.perf_counter() - start)
+                    self.prefetching.pop(m, None)
+                    self.prefetches += 1
+                print('Load to GPU:', self.name_fn(m))
+        except Exception as e:
+            print('Prefetch failed:', e)
+        finally:
+            with self.lock:
+                for m in models + [m for m, size in evicted]:
+                    self.prefetching.pop(m, None)
+                    self.incoming.pop(m, None)
+        return
+
+    def wait_for_prefetch(self, models):
+        # The threads are joined without the lock, they need it to finish
+        with self.lock:
+            threads = set(self.prefetching.get(m) for m in models) - {None}
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        self.seconds_waiting += time.perf_counter() - start
+
+        with self.lock:
+            for m in models:
+                event = self.events.pop(m, None)
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+        return
+
+    def models_over_budget(self, incoming_bytes, protected):
+        # The least recently used models to unload so that incoming_bytes more fit the budget,
+        # counting the models that are being prefetched
+        models_to_unload = []
+
+        if self.budget_bytes is not None:
+            required_bytes = self.resident_bytes() + sum(self.incoming.values()) + incoming_bytes
+
+            for m, size in self.resident.items():
+                if required_bytes <= self.budget_bytes:
+                    break
+                if m not in protected:
+                    models_to_unload.append(m)
+                    required_bytes -= size
+
+        return models_to_unload
+
+    def load_unlocked(self, models, protected):
+        models_to_load = [m for m in models if m not in self.resident]
+
+        for m in models:
+            if m in self.resident:
+                self.resident.move_to_end(m)
+
+        sizes = {m: self.size_fn(m) for m in models_to_load}
+        self.unload(self.models_over_budget(sum(sizes.values()), protected))
+
+        for m in models_to_load:
+            start = time.perf_counter()
+            self.move_fn(m, self.device, False)
+            self.resident[m] = sizes[m]
+            self.record('load', m, sizes[m], time.perf_counter() - start)
+            print('Load to GPU:', self.name_fn(m))
+
+        return
+
+    def unload(self, models):
+        with self.lock:
+            models = [m for m in dict.fromkeys(models) if m in self.resident]
+
+            # weights may still be read by queued kernels or copies on the other stream
+            if self.use_streams and len(models) > 0:
+                torch.cuda.synchronize(self.device)
+
+            for m in models:
+                start = time.perf_counter()
+                self.move_fn(m, self.offload_device, False)
+                size = self.resident.pop(m)
+                self.events.pop(m, None)
+                self.record('unload', m, size, time.perf_counter() - start)
+                print('Unload to CPU:', self.name_fn(m))
+
+        if len(models) > 0:
+            if self.empty_cache_fn is not None:
+                self.empty_cache_fn()
+            gc.collect()
+        return
+
+    def unload_all(self):
+        with self.lock:
+            models = list(self.prefetching.keys())
+        self.wait_for_prefetch(models)
+        return self.unload(list(self.resident.keys()))
+
+    def mark_resident(self, models):
+        # For models that were put on the device without the manager
+        with self.lock:
+            for m in models:
+                if m not in self.resident:
+                    self.resident[m] = self.size_fn(m)
+        return
+
+    def record_move(self, m, device, seconds):
+        # For models moved without the manager, e.g. by pipeline.to(), keeps the residency set in sync
+        with self.lock:
+            size = self.size_fn(m)
+            if torch.device(device).type == self.device.type:
+                self.resident[m] = size
+                self.resident.move_to_end(m)
+                self.record('load', m, size, seconds)
+            else:
+                self.resident.pop(m, None)
+                self.events.pop(m, None)
+                self.record('unload', m, size, seconds)
+        return
+
+    def forget(self, models):
+        # For models that are about to be deleted, so that the manager does not keep them alive
+        self.wait_for_prefetch(models)
+        with self.lock:
+            for m in models:
+                self.resident.pop(m, None)
+                self.events.pop(m, None)
+            self.active = [m for m in self.active if m not in models]
+        return
+
+    def stats(self):
+        # Prefetch threads update the counters and dicts, they are read in one go under the lock
+        with self.lock:
+            return dict(
+                loads=self.loads,
+                unloads=self.unloads,
+                bytes_loaded=self.bytes_loaded,
+                bytes_unloaded=self.bytes_unloaded,
+                seconds_loading=self.seconds_loading,
+                seconds_unloading=self.seconds_unloading,
+                prefetches=self.prefetches,
+                seconds_waiting=self.seconds_waiting,
+                resident_bytes=self.resident_bytes(),
+                budget_bytes=self.budget_bytes,
+                resident={self.name_fn(m): size for m, size in self.resident.items()},
+                models={name: dict(model_stats) for name, model_stats in self.model_stats.items()},
+            )
+
+
+def module_tensors(m):
+    return list(itertools.chain(m.parameters(), m.buffers()))
+
+
+def split_blocks(model, max_block_bytes=None):
+    # The children of the model that hold weights, with ModuleLists expanded. Blocks larger than max_block_bytes
+    # are split into their children again, unless they hold weights of their own.
+    blocks = []
+
+    for child in model.children():
+        size = model_bytes(child)
+        if size == 0:
+            continue
+
+        has_own_tensors = len(list(itertools.chain(child.parameters(recurse=False), child.buffers(recurse=False)))) > 0
+        is_container = isinstance(child, (torch.nn.ModuleList, torch.nn.ModuleDict))
+        is_too_large = max_block_bytes is not None and size > max_block_bytes
+
+        if is_container or (is_too_large and not has_own_tensors):
+            blocks.extend(split_blocks(child, max_block_bytes))
+        else:
+            blocks.append(child)
+
+    return blocks
+
+
+class SequentialBlockOffload:
+    # Streams the blocks of a model (see split_blocks) to the compute device one at a time while it runs, instead
+    # of loading the whole model. Weights stay in host memory, pinned when the device is a GPU. A block is copied to
+    # the device right before it runs and its device copy is dropped right after, nothing is copied back, so the
+    # weights must not change while installed. Blocks run in the order of the first forward pass, from then on each
+    # block starts copying the next one on a side CUDA stream, so about two blocks are on the device at a time.
+
+    def __init__(self, model, device, offload_device=None, max_block_bytes=None, pin_memory=None):
+        self.model = model
+        self.device = device
+        self.offload_device = cpu if offload_device is None else offload_device
+        self.max_block_bytes = max_block_bytes
+        self.use_streams = device.type == 'cuda'
+        self.pin_memory = self.use_streams if pin_memory is None else pin_memory
+        self.stream = None
+        self.blocks = []
+        self.block_bytes = {}
+        self.order = []
+        self.positions = {}
+        self.resident = {}
+        self.events = {}
+        self.handles = []
+        self.loads = 0
+        self.prefetches = 0
+        self.bytes_loaded = 0
+        self.seconds_loading = 0.0
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+        return
+
+    def install(self):
+        if len(self.handles) > 0:
+            return
+
+        # Split again every time, loading a LoRA replaces modules
+        blocks = split_blocks(self.model, self.max_block_bytes)
+        if blocks != self.blocks:
+            self.blocks = blocks
+            self.order = []
+            self.positions = {}
+
+        self.block_bytes = {block: model_bytes(block) for block in self.blocks}
+        assert sum(self.block_bytes.values()) == model_bytes(self.model), 'Some weights are not in any block!'
+
+        for block in self.blocks:
+            for t in module_tensors(block):
+                assert t.device == self.offload_device, 'Move the model to the offload device before streaming it!'
+                if self.pin_memory and not t.is_pinned():
+                    t.data = t.data.pin_memory()
+
+            self.handles.append(block.register_forward_pre_hook(self.before_block))
+            self.handles.append(block.register_forward_hook(self.after_block))
+
+        # Peak of the current run
+        self.peak_resident_bytes = self.resident_bytes
+        return
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+        for block in list(self.resident.keys()):
+            self.release(block)
+        return
+
+    def load(self, block, non_blocking=False):
+        start = time.perf_counter()
+        saved = []
+        for t in module_tensors(block):
+            saved.append((t, t.data))
+            t.data = t.data.to(self.device, non_blocking=non_blocking)
+        self.seconds_loading += time.perf_counter() - start
+
+        self.resident[block] = saved
+        self.resident_bytes += self.block_bytes[block]
+        self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+        self.loads += 1
+        self.bytes_loaded += self.block_bytes[block]
+        return
+
+    def release(self, block):
+        saved = self.resident.pop(block, None)
+        if saved is None:
+            return
+
+        for t, host_data in saved:
+            t.data = host_data
+        self.resident_bytes -= self.block_bytes[block]
+        self.events.pop(block, None)
+        return
+
+    def prefetch(self, block):
+        if block in self.resident:
+            return
+
+        self.prefetches += 1
+
+        if not self.use_streams:
+            self.load(block)
+            return
+
+        if self.stream is None:
+            self.stream = torch.cuda.Stream(self.device)
+
+        with torch.cuda.stream(self.stream):
+            self.load(block, non_blocking=True)
+            self.events[block] = torch.cuda.Event()
+            self.events[block].record(self.stream)
+        return
+
+    def before_block(self, block, args):
+        if block not in self.positions:
+            self.positions[block] = len(self.order)
+            self.order.append(block)
+            is_first_pass = True
+        else:
+            is_first_pass = False
+
+        if block not in self.resident:
+            self.load(block, non_blocking=self.pin_memory)
+
+        event = self.events.pop(block, None)
+        if event is not None:
+            # The copies ran on the side stream, the allocator must not reuse them before this stream is done
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for t, host_data in self.resident[block]:
+                t.data.record_stream(current_stream)
+
+        if not is_first_pass:
+            self.prefetch(self.order[(self.positions[block] + 1) % len(self.order)])
+        return
+
+    def after_block(self, block, args, output):
+        self.release(block)
+        return
+
+    def stats(self):
+        return dict(
+            blocks=len(self.blocks),
+            max_block_bytes=max(self.block_bytes.values(), default=0),
+            model_bytes=sum(self.block_bytes.values()),
+            loads=self.loads,
+            prefetches=self.prefetches,
+            bytes_loaded=self.bytes_loaded,
+            seconds_loading=self.seconds_loading,
+            resident_bytes=self.resident_bytes,
+            peak_resident_bytes=self.peak_resident_bytes,
+        )
+
+
+def parse_device(spec):
+    # Device indices are CUDA devices, also as strings such as '1' from the command line
+    if isinstance(spec, int) or (isinstance(spec, str) and spec.isdigit()):
+        spec = f'cuda:{spec}'
+    return torch.device(spec)
+
+
+def device_index(d):
+    # 'cuda' without an index is the current CUDA device
+    if d.type == 'cuda' and d.index is None:
+        return torch.cuda.current_device()
+    return d.index
+
+
+def set_device(spec):
+    # 'cuda', 'cpu', 'cuda:1', a device index or a torch.device. Must be called before the device is first used.
+    global device_spec
+    requested = parse_device(spec)
+    assert device is None or (requested.type == device.type and device_index(requested) == device_index(device)), \
+        f'The device is already initialized as [{device}]!'
+    device_spec = spec
+    return
+
+
+def get_device():
+    global device
+
+    if device is None:
+        created = parse_device(device_spec)
+
+        if created.type == 'cuda':
+            assert torch.cuda.is_available(), f'Device [{created}] is not available!'
+            if created.index is not None:
+                torch.cuda.set_device(created)
+            torch.zeros((1, 1)).to(created, torch.float32)
+            torch.cuda.empty_cache()
+
+        device = created
+        print('Compute device:', device)
+    return device
+
+
+def get_manager():
+    global residency_manager
+
+    if residency_manager is None:
+        compute_device = get_device()
+        is_cuda = compute_device.type == 'cuda'
+        residency_manager = ModelResidencyManager(compute_device, cpu, budget_bytes=budget_bytes,
+                                                  empty_cache_fn=torch.cuda.empty_cache if is_cuda else None,
+                                                  pin_memory=is_cuda, log_path=transfer_log_path)
+    return residency_manager
+
+
+def __getattr__(name):
+    if name == 'gpu':
+        return get_device()
+    if name == 'manager':
+        return get_manager()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def empty_cache():
+    # Only when CUDA is in use, never initializes it
+    if device is not None and device.type == 'cuda':
+        torch.cuda.empty_cache()
+    gc.collect()
+    return
+
+
+def set_budget(budget):
+    # None keeps every loaded model on the GPU
+    global budget_bytes
+    budget_bytes = budget
+    if residency_manager is not None:
+        residency_manager.budget_bytes = budget
+    return
+
+
+def set_transfer_log(log_path):
+    # Appends one JSON line per model transfer to log_path, None stops logging
+    global transfer_log_path
+    transfer_log_path = log_path
+    if residency_manager is not None:
+        residency_manager.set_log(log_path)
+    return
+
+
+def name_models(models):
+    # A dict of name to model, the names are used in the transfer statistics and the log
+    for name, m in models.items():
+        model_names[m] = name
+    return
+
+
+def get_transfer_stats():
+    # Transfer counts, bytes and seconds in total and per model name, and the models currently on the device
+    return get_manager().stats()
+
+
+def reset_transfer_stats():
+    return get_manager().reset_stats()
+
+
+def record_model_move(m, device, seconds):
+    # A CPU-only worker has nothing resident and must not create the CUDA device
+    if residency_manager is None and torch.device(device).type == 'cpu':
+        return
+    return get_manager().record_move(m, device, seconds)
+
+
 def load_models_to_gpu(models):
-    global models_in_gpu
+    if not isinstance(models, (tuple, list)):
+        models = [models]
+
+    return get_manager().load(models)
 
+
+def prefetch_models_to_gpu(models):
+    # Starts loading the models of the next stage, load_models_to_gpu waits for it when they are needed
     if not isinstance(models, (tuple, list)):
         models = [models]
 
-    models_to_remain = [m for m in set(models) if m in models_in_gpu]
-    models_to_load = [m for m in set(models) if m not in models_in_gpu]
-    models_to_unload = [m for m in set(models_in_gpu) if m not in models_to_remain]
-
-    if not high_vram:
-        for m in models_to_unload:
-            with movable_bnb_model(m):
-                m.to(cpu)
-            print('Unload to CPU:', m.__class__.__name__)
-        models_in_gpu = models_to_remain
-
-    for m in models_to_load:
-        with movable_bnb_model(m):
-            # Using `to_empty` to avoid copying meta tensors directly to GPU
-            m.to(gpu)
-        print('Load to GPU:', m.__class__.__name__)
-
-    models_in_gpu = list(set(models_in_gpu + models))
-    torch.cuda.empty_cache()
-    gc.collect()
-    return
+    return get_manager().prefetch(models)
 
 
-def unload_all_models(extra_models=None):
-    global models_in_gpu
+def unload_models(models):
+    if not isinstance(models, (tuple, list)):
+        models = [models]
 
+    return get_manager().unload(models)
+
+
+def forget_models(models):
+    if not isinstance(models, (tuple, list)):
+        models = [models]
+
+    return get_manager().forget(models)
+
+
+def unload_all_models(extra_models=None):
     if extra_models is None:
         extra_models = []
 
     if not isinstance(extra_models, (tuple, list)):
         extra_models = [extra_models]
 
-    models_in_gpu = list(set(models_in_gpu + extra_models))
-
-    return load_models_to_gpu([])
+    get_manager().mark_resident(extra_models)
 
+    return get_manager().unload_all()
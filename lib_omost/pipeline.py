@@ -1,8 +1,14 @@
 import numpy as np
 import copy
+import json
+import time
+
+from collections import OrderedDict
 
 from diffusers.utils import is_torch_version
 from tqdm.auto import trange
+from lib_omost.canvas import Region
+import lib_omost.memory_management as memory_management
 from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl_img2img import *
 from diffusers.models.transformers import Transformer2DModel
 
@@ -98,8 +104,14 @@ class KModel:
         x_ddim_space = x / (sigma[:, None, None, None] ** 2 + self.sigma_data ** 2) ** 0.5
         t = self.timestep(sigma)
         cfg_scale = extra_args['cfg_scale']
-        eps_positive = self.unet(x_ddim_space, t, return_dict=False, **extra_args['positive'])[0]
-        eps_negative = self.unet(x_ddim_space, t, return_dict=False, **extra_args['negative'])[0]
+        if 'batched' in extra_args:
+            x_batched = torch.cat([x_ddim_space, x_ddim_space], dim=0)
+            t_batched = torch.cat([t, t], dim=0)
+            eps = self.unet(x_batched, t_batched, return_dict=False, **extra_args['batched'])[0]
+            eps_positive, eps_negative = eps.chunk(2, dim=0)
+        else:
+            eps_positive = self.unet(x_ddim_space, t, return_dict=False, **extra_args['positive'])[0]
+            eps_negative = self.unet(x_ddim_space, t, return_dict=False, **extra_args['negative'])[0]
         noise_pred = eps_negative + cfg_scale * (eps_positive - eps_negative)
         return x - noise_pred * sigma[:, None, None, None]
 
@@ -131,30 +143,154 @@ class OmostSelfAttnProcessor:
         return hidden_states
 
 
+class RegionalConditions(list):
+    # A list of (mask, cond) pairs for one CFG branch of one generation.
+    # Masks only depend on the latent resolution, so they are built once per (H, W)
+    # and shared by all cross-attention layers and all sampling steps.
+    # With cache_kv, the K/V projections of the conds are also kept per attention layer,
+    # since the conds do not change during sampling.
+    # attention_mode is 'dense' (explicit similarity matrix), 'sdpa' (fused attention with an additive
+    # mask, optionally in chunks of query_chunk_size latent pixels to bound peak memory) or 'sparse'
+    # (attention computed only between pixels and the tokens of the regions that cover them).
+
+    def __init__(self, pairs=(), cache_kv=False, attention_mode='dense', query_chunk_size=None):
+        super().__init__(pairs)
+        assert attention_mode in ['dense', 'sdpa', 'sparse'], f'Unknown cross-attention mode [{attention_mode}]!'
+        self.conds = None
+        self.mask_cache = {}
+        self.kv_cache = {} if cache_kv else None
+        self.attention_mode = attention_mode
+        self.query_chunk_size = query_chunk_size
+        return
+
+    def get_conds(self):
+        if self.conds is None:
+            self.conds = torch.cat([c for m, c in self], dim=1)
+        return self.conds
+
+    def resize_mask(self, m, H, W):
+        # Masks are 90*90 tensors or canvas Regions, which are built directly at (H, W) from their rects
+        if isinstance(m, Region):
+            m = torch.from_numpy(m.materialize(H, W))
+        else:
+            m = torch.nn.functional.interpolate(m[None, None, :, :], (H, W), mode='nearest-exact')[0, 0]
+        return m.to(self[0][1].device)
+
+    def get_masks(self, H, W):
+        if (H, W) not in self.mask_cache:
+            masks = []
+
+            for m, c in self:
+                m = self.resize_mask(m, H, W).flatten()
+                masks.append(m.unsqueeze(1).repeat(1, c.size(1)))
+
+            masks = torch.cat(masks, dim=1)
+
+            mask_bool = masks > 0.5
+            mask_scale = (H * W) / torch.sum(masks, dim=0, keepdim=True)
+
+            self.mask_cache[(H, W)] = mask_bool, mask_scale
+        return self.mask_cache[(H, W)]
+
+    def get_key_scale(self, H, W):
+        # The mask_scale for folding into the keys. Tokens of a region that is empty at this resolution have an
+        # infinite scale, which would turn the keys into inf/NaN that no bias can mask, and they are masked anyway.
+        if (H, W, 'key_scale') not in self.mask_cache:
+            mask_scale = self.get_masks(H, W)[1]
+            key_scale = torch.where(torch.isfinite(mask_scale), mask_scale, torch.zeros_like(mask_scale))
+            self.mask_cache[(H, W, 'key_scale')] = key_scale
+        return self.mask_cache[(H, W, 'key_scale')]
+
+    def get_attn_bias(self, H, W, dtype):
+        if (H, W, dtype) not in self.mask_cache:
+            mask_bool = self.get_masks(H, W)[0]
+            attn_bias = torch.zeros(mask_bool.shape, dtype=dtype, device=mask_bool.device)
+            attn_bias.masked_fill_(mask_bool.logical_not(), float("-inf"))
+            self.mask_cache[(H, W, dtype)] = attn_bias
+        return self.mask_cache[(H, W, dtype)]
+
+    def get_region_groups(self, H, W):
+        # Pixels covered by the same set of regions attend to the same tokens without any masking.
+        # Canvas regions are rectangles, so these groups are the blocks cut out by the rectangle edges,
+        # and the total cost is the sum of (pixels x tokens) over groups instead of HW x total_tokens.
+        if (H, W, 'groups') not in self.mask_cache:
+            region_masks = []
+            token_spans = []
+            start = 0
+
+            for m, c in self:
+                m = self.resize_mask(m, H, W).flatten()
+                region_masks.append(m.cpu() > 0.5)
+                token_spans.append(torch.arange(start, start + c.size(1)))
+                start += c.size(1)
+
+            region_masks = torch.stack(region_masks, dim=1).to(torch.uint8)
+            patterns, inverse = torch.unique(region_masks, dim=0, return_inverse=True)
+            device = self[0][1].device
+            groups = []
+
+            for i, pattern in enumerate(patterns):
+                if not pattern.any():
+                    continue
+                pixel_index = torch.nonzero(inverse == i).flatten()
+                token_index = torch.cat([token_spans[r] for r in torch.nonzero(pattern).flatten().tolist()])
+                groups.append((pixel_index.to(device), token_index.to(device)))
+
+            self.mask_cache[(H, W, 'groups')] = groups
+        return self.mask_cache[(H, W, 'groups')]
+
+    def get_kv(self, attn):
+        if self.kv_cache is not None and attn in self.kv_cache:
+            return self.kv_cache[attn]
+
+        conds = self.get_conds()
+        kv = attn.to_k(conds), attn.to_v(conds)
+
+        if self.kv_cache is not None:
+            self.kv_cache[attn] = kv
+        return kv
+
+    def kv_cache_bytes(self):
+        if self.kv_cache is None:
+            return 0
+        return sum(t.numel() * t.element_size() for kv in self.kv_cache.values() for t in kv)
+
+    def clear_kv_cache(self):
+        if self.kv_cache is not None:
+            self.kv_cache.clear()
+        return
+
+
+class BatchedRegionalConditions(list):
+    # RegionalConditions of several CFG branches that are concatenated along the batch dimension
+    # of a single UNet call. Each branch covers as many batch items as its conds.
+    pass
+
+
 class OmostCrossAttnProcessor:
     def __call__(self, attn, hidden_states, encoder_hidden_states, hidden_states_original_shape, *args, **kwargs):
         B, C, H, W = hidden_states_original_shape
 
-        conds = []
-        masks = []
-
-        for m, c in encoder_hidden_states:
-            m = torch.nn.functional.interpolate(m[None, None, :, :], (H, W), mode='nearest-exact').flatten().unsqueeze(
-                1).repeat(1, c.size(1))
-            conds.append(c)
-            masks.append(m)
+        if isinstance(encoder_hidden_states, BatchedRegionalConditions):
+            branches = encoder_hidden_states
+        elif isinstance(encoder_hidden_states, RegionalConditions):
+            branches = [encoder_hidden_states]
+        else:
+            branches = [RegionalConditions(encoder_hidden_states)]
 
-        conds = torch.cat(conds, dim=1)
-        masks = torch.cat(masks, dim=1)
+        query = attn.to_q(hidden_states)
+        split_sizes = [conditions.get_conds().size(0) for conditions in branches]
 
-        mask_bool = masks > 0.5
-        mask_scale = (H * W) / torch.sum(masks, dim=0, keepdim=True)
+        h = [self.attention(attn, q, conditions, H, W) for q, conditions in zip(query.split(split_sizes), branches)]
+        h = torch.cat(h, dim=0) if len(h) > 1 else h[0]
 
-        batch_size, sequence_length, _ = conds.shape
+        h = attn.to_out[0](h)
+        h = attn.to_out[1](h)
+        return h
 
-        query = attn.to_q(hidden_states)
-        key = attn.to_k(conds)
-        value = attn.to_v(conds)
+    def attention(self, attn, query, conditions, H, W):
+        batch_size = query.size(0)
+        key, value = conditions.get_kv(attn)
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -163,6 +299,19 @@ class OmostCrossAttnProcessor:
         key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
         value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
+        if conditions.attention_mode == 'sdpa':
+            h = self.sdpa_attention(attn, query, key, value, conditions, H, W)
+        elif conditions.attention_mode == 'sparse':
+            h = self.sparse_attention(attn, query, key, value, conditions, H, W)
+        else:
+            h = self.dense_attention(attn, query, key, value, conditions, H, W)
+
+        return h.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+
+    @staticmethod
+    def dense_attention(attn, query, key, value, conditions, H, W):
+        mask_bool, mask_scale = conditions.get_masks(H, W)
+
         mask_bool = mask_bool[None, None, :, :].repeat(query.size(0), query.size(1), 1, 1)
         mask_scale = mask_scale[None, None, :, :].repeat(query.size(0), query.size(1), 1, 1)
 
@@ -171,14 +320,300 @@ class OmostCrossAttnProcessor:
         sim.masked_fill_(mask_bool.logical_not(), float("-inf"))
         sim = sim.softmax(dim=-1)
 
-        h = sim @ value
-        h = h.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        return sim @ value
+
+    @staticmethod
+    def sdpa_attention(attn, query, key, value, conditions, H, W):
+        # The mask_scale multiplies the logits of each token, so it is folded into the keys,
+        # and the region mask becomes an additive bias that is broadcast over batch and heads.
+        key_scale = conditions.get_key_scale(H, W)
+        attn_bias = conditions.get_attn_bias(H, W, query.dtype)
+
+        key = key * key_scale.to(key).view(1, 1, -1, 1)
+
+        chunk_size = conditions.query_chunk_size or query.size(2)
+        results = []
+
+        for i in range(0, query.size(2), chunk_size):
+            results.append(torch.nn.functional.scaled_dot_product_attention(
+                query[:, :, i:i + chunk_size], key, value,
+                attn_mask=attn_bias[None, None, i:i + chunk_size].expand(query.size(0), query.size(1), -1, -1),
+                dropout_p=0.0, is_causal=False, scale=attn.scale
+            ))
+
+        return torch.cat(results, dim=2) if len(results) > 1 else results[0]
+
+    @staticmethod
+    def sparse_attention(attn, query, key, value, conditions, H, W):
+        key_scale = conditions.get_key_scale(H, W)
+        key = key * key_scale.to(key).view(1, 1, -1, 1)
+
+        h = query.new_zeros(query.shape[:-1] + value.shape[-1:])
+
+        for pixel_index, token_index in conditions.get_region_groups(H, W):
+            h[:, :, pixel_index] = torch.nn.functional.scaled_dot_product_attention(
+                query[:, :, pixel_index], key[:, :, token_index], value[:, :, token_index],
+                attn_mask=None, dropout_p=0.0, is_causal=False, scale=attn.scale
+            )
 
-        h = attn.to_out[0](h)
-        h = attn.to_out[1](h)
         return h
 
 
+class TokenizationCache:
+    # LRU of token ids (without special tokens) keyed by tokenizer and string.
+    # Uncached strings are tokenized with one batched call per tokenizer.
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.tokenizers = {}  # keeps tokenizers alive so that their ids stay unique
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def tokenize(self, tokenizer, strings):
+        self.tokenizers[id(tokenizer)] = tokenizer
+        missing = list(dict.fromkeys(x for x in strings if (id(tokenizer), x) not in self.entries))
+
+        if len(missing) > 0:
+            input_ids = tokenizer(missing, truncation=False, add_special_tokens=False).input_ids
+            for x, ids in zip(missing, input_ids):
+                self.entries[(id(tokenizer), x)] = ids
+
+        self.misses += len(missing)
+        self.hits += len(strings) - len(missing)
+
+        results = []
+        for x in strings:
+            self.entries.move_to_end((id(tokenizer), x))
+            results.append(self.entries[(id(tokenizer), x)])
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return results
+
+
+def tokenizers_share_vocabulary(tokenizer, tokenizer_2):
+    # Two tokenizers produce the same ids (without special tokens) if they share vocabulary and merges
+    if tokenizer is tokenizer_2:
+        return True
+    if type(tokenizer) is not type(tokenizer_2) or tokenizer.get_vocab() != tokenizer_2.get_vocab():
+        return False
+    if hasattr(tokenizer, 'backend_tokenizer'):
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        state_2 = json.loads(tokenizer_2.backend_tokenizer.to_str())
+        return all(state[k] == state_2[k] for k in ['normalizer', 'pre_tokenizer', 'model'])
+    return getattr(tokenizer, 'bpe_ranks', None) == getattr(tokenizer_2, 'bpe_ranks', None)
+
+
+def first_fit_decreasing_partition(items, max_sum):
+    # Longest items first, each into the first bag with room left. Items keep their original order inside bags.
+    bags = []
+    sums = []
+
+    for i in sorted(range(len(items)), key=lambda i: items[i]['length'], reverse=True):
+        num = items[i]['length']
+        for j in range(len(bags)):
+            if sums[j] + num <= max_sum:
+                bags[j].append(i)
+                sums[j] += num
+                break
+        else:
+            bags.append([i])
+            sums.append(num)
+
+    bags = sorted([sorted(bag) for bag in bags])
+    return [[items[i] for i in bag] for bag in bags]
+
+
+def optimal_partition(items, max_sum, max_items=12):
+    # Exact minimum number of bags by dynamic programming over subsets of items.
+    # dp[mask] is the best (bags, fill of the last bag) to pack the items in mask.
+    # Items that can never share a bag are packed alone; too many items fall back to first-fit-decreasing.
+    large = [i for i, item in enumerate(items) if item['length'] > max_sum]
+    small = [i for i, item in enumerate(items) if item['length'] <= max_sum]
+
+    if len(small) > max_items:
+        return first_fit_decreasing_partition(items, max_sum)
+
+    lengths = [items[i]['length'] for i in small]
+    dp = [None] * (1 << len(small))
+    parent = [None] * (1 << len(small))
+    dp[0] = (0, max_sum + 1)  # no bag is open yet
+
+    for mask in range(1 << len(small)):
+        if dp[mask] is None:
+            continue
+        bags, fill = dp[mask]
+        for k in range(len(small)):
+            if mask & (1 << k):
+                continue
+            if fill + lengths[k] <= max_sum:
+                candidate = (bags, fill + lengths[k])
+            else:
+                candidate = (bags + 1, lengths[k])
+            new_mask = mask | (1 << k)
+            if dp[new_mask] is None or candidate < dp[new_mask]:
+                dp[new_mask] = candidate
+                parent[new_mask] = (mask, k, candidate[0] != bags)
+
+    bags = [[i] for i in large]
+    mask = (1 << len(small)) - 1
+    current_bag = []
+
+    while mask != 0:
+        mask, k, opened_bag = parent[mask]
+        current_bag.append(small[k])
+        if opened_bag:
+            bags.append(current_bag)
+            current_bag = []
+
+    bags = sorted([sorted(bag) for bag in bags])
+    return [[items[i] for i in bag] for bag in bags]
+
+
+def clip_attention(attn, query_states, key_states, value_states, causal_attention_mask):
+    # Same computation as CLIPAttention.forward, but keys and values may cover more positions than queries
+    bsz, tgt_len, embed_dim = query_states.size()
+    src_len = key_states.size(1)
+
+    query_states = query_states * attn.scale
+    query_states = attn._shape(query_states, tgt_len, bsz).view(bsz * attn.num_heads, tgt_len, attn.head_dim)
+    key_states = attn._shape(key_states, src_len, bsz).view(bsz * attn.num_heads, src_len, attn.head_dim)
+    value_states = attn._shape(value_states, src_len, bsz).view(bsz * attn.num_heads, src_len, attn.head_dim)
+
+    attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+    attn_weights = attn_weights.view(bsz, attn.num_heads, tgt_len, src_len) + causal_attention_mask
+    attn_weights = attn_weights.view(bsz * attn.num_heads, tgt_len, src_len)
+    attn_weights = torch.nn.functional.softmax(attn_weights, dim=-1)
+
+    attn_output = torch.bmm(attn_weights, value_states)
+    attn_output = attn_output.view(bsz, attn.num_heads, tgt_len, attn.head_dim)
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+    return attn.out_proj(attn_output)
+
+
+def clip_encode_positions(text_model, input_ids, start, past_kv, causal_attention_mask):
+    # Runs the positions from start on for every row of input_ids, which holds the tokens from start on.
+    # past_kv holds the keys and values of the positions before start in every layer, as a batch of 1 shared by
+    # all rows, so every query still attends to all positions up to its own.
+    # Returns the penultimate and last hidden states and the keys and values of the positions that were run.
+    batch_size, length = input_ids.shape
+    positions = torch.arange(start, start + length, device=input_ids.device)[None]
+    states = text_model.embeddings(input_ids=input_ids, position_ids=positions)
+
+    penultimate_states = None
+    layers = text_model.encoder.layers
+    kv = []
+
+    for i, layer in enumerate(layers):
+        attn = layer.self_attn
+        x = layer.layer_norm1(states)
+        k, v = attn.k_proj(x), attn.v_proj(x)
+        kv.append((k, v))
+
+        if start > 0:
+            k = torch.cat([past_kv[i][0].expand(batch_size, -1, -1), k], dim=1)
+            v = torch.cat([past_kv[i][1].expand(batch_size, -1, -1), v], dim=1)
+
+        states = states + clip_attention(attn, attn.q_proj(x), k, v, causal_attention_mask[:, :, start:, :])
+        states = states + layer.mlp(layer.layer_norm2(states))
+
+        if i == len(layers) - 2:
+            penultimate_states = states
+
+    return penultimate_states, states, kv
+
+
+@torch.inference_mode()
+def encode_with_shared_prefixes(text_encoder, input_ids, prefix_lengths):
+    # CLIP text encoders are causal, so the hidden states of a prefix do not depend on what follows.
+    # All chunks of a canvas start with bos and the global description, and the chunks of one region also share
+    # the region's description (its first prefix_lengths tokens). Positions are encoded in three steps:
+    #   1. the first row in full
+    #   2. from the prefix common to all rows on, the first row of every other region
+    #   3. from the region prefix on, the remaining rows of every region
+    # Each step attends to the prefix keys and values of the steps before it in every layer. Rows without a prefix
+    # (prefix_lengths of 0, e.g. the negative prompt) are encoded in full with the first row.
+    # Returns the penultimate hidden states and the pooled output, like text_encoder(...) in double_encode.
+    text_model = text_encoder.text_model
+    batch_size, seq_length = input_ids.shape
+    device = input_ids.device
+    dtype = text_model.embeddings.token_embedding.weight.dtype
+
+    ids = input_ids.tolist()
+    prefixed_rows = [i for i, prefix_length in enumerate(prefix_lengths) if prefix_length > 0]
+    first = prefixed_rows[0] if len(prefixed_rows) > 0 else 0
+    full_rows = [first] + [i for i, prefix_length in enumerate(prefix_lengths) if prefix_length == 0 and i != first]
+
+    common_length = 0
+    if len(prefixed_rows) > 0:
+        max_common_length = min(prefix_lengths[i] for i in prefixed_rows)
+        while common_length < max_common_length and \
+                all(ids[i][common_length] == ids[first][common_length] for i in prefixed_rows):
+            common_length += 1
+
+    groups = {}
+    for i in prefixed_rows:
+        groups.setdefault(tuple(ids[i][:prefix_lengths[i]]), []).append(i)
+
+    lead_rows = []
+    shared = []
+
+    for prefix, rows in groups.items():
+        if len(prefix) > common_length and len(rows) > 1:
+            lead_rows.append(rows[0])
+            shared.append((len(prefix), rows[0], rows[1:]))
+        else:
+            lead_rows.extend(rows)
+
+    lead_rows = [i for i in lead_rows if i != first]
+
+    causal_attention_mask = torch.full((seq_length, seq_length), torch.finfo(dtype).min,
+                                       dtype=dtype, device=device).triu(1)[None, None]
+    penultimate_states = torch.empty((batch_size, seq_length, text_model.config.hidden_size), dtype=dtype,
+                                     device=device)
+    last_states = torch.empty_like(penultimate_states)
+
+    def encode_rows(rows, start, past_kv, source_row):
+        # The positions before start are copied from source_row, which has the same tokens there
+        penultimate, last, kv = clip_encode_positions(text_model, input_ids[rows, start:], start, past_kv,
+                                                      causal_attention_mask)
+        penultimate_states[rows, start:] = penultimate
+        last_states[rows, start:] = last
+        if start > 0:
+            penultimate_states[rows, :start] = penultimate_states[source_row, :start]
+            last_states[rows, :start] = last_states[source_row, :start]
+        return kv
+
+    kv_first = [(k[:1], v[:1]) for k, v in encode_rows(full_rows, 0, None, None)]
+
+    if len(lead_rows) > 0:
+        kv_leads = encode_rows(lead_rows, common_length,
+                               [(k[:, :common_length], v[:, :common_length]) for k, v in kv_first], first)
+
+    for prefix_length, lead, rows in shared:
+        if lead == first:
+            past_kv = [(k[:, :prefix_length], v[:, :prefix_length]) for k, v in kv_first]
+        else:
+            j = lead_rows.index(lead)
+            past_kv = [(torch.cat([k_first[:, :common_length], k[j:j + 1, :prefix_length - common_length]], dim=1),
+                        torch.cat([v_first[:, :common_length], v[j:j + 1, :prefix_length - common_length]], dim=1))
+                       for (k_first, v_first), (k, v) in zip(kv_first, kv_leads)]
+        encode_rows(rows, prefix_length, past_kv, lead)
+
+    last_hidden_state = text_model.final_layer_norm(last_states)
+
+    if text_model.eos_token_id == 2:
+        eos_positions = input_ids.to(dtype=torch.int).argmax(dim=-1)
+    else:
+        eos_positions = (input_ids.to(dtype=torch.int) == text_model.eos_token_id).int().argmax(dim=-1)
+
+    pooled_output = last_hidden_state[torch.arange(batch_size, device=device), eos_positions]
+    return penultimate_states, pooled_output
+
+
 class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
     def __init__(self,
                  vae: AutoencoderKL,
@@ -212,6 +647,25 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
         self.text_encoder_2 = text_encoder_2
         self.unet = unet
 
+        # Text embeddings are only cached when the caller identifies the loaded checkpoint
+        self.embedding_cache = None
+        self.model_identity = None
+        self.lora_identity = ''
+
+        # Encode the shared prefix of prompt chunks once, see encode_with_shared_prefixes
+        self.prefix_reuse_encoding = False
+
+        # How suffixes are packed into 77-token chunks: 'greedy' (in order), 'first_fit_decreasing' or 'optimal'
+        self.chunk_packing = 'greedy'
+        self.chunk_packing_stats = dict(chunks=0, greedy_chunks=0)
+
+        # SDXL's two tokenizers usually only differ in their pad token, then one of them is enough
+        self.tokenization_cache = TokenizationCache()
+        self.tokenizers_share_vocabulary = None
+
+        # Created by the first call with sequential_offload, keeps the pinned host copies of the UNet weights
+        self.unet_offload = None
+
         attn_procs = {}
         for name in self.unet.attn_processors.keys():
             if name.endswith("attn2.processor"):
@@ -225,9 +679,14 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
     def to(self, *args, **kwargs):
         # Remove silence_dtype_warnings from kwargs if present
         kwargs.pop('silence_dtype_warnings', None)
+        device = kwargs.get('device', next((a for a in args if isinstance(a, (str, torch.device))), None))
         for k, v in self.loading_components.items():
             if hasattr(v, 'to'):
+                start = time.perf_counter()
                 v.to(*args, **kwargs)
+                if device is not None and isinstance(v, torch.nn.Module):
+                    memory_management.name_models({k: v})
+                    memory_management.record_model_move(v, device, time.perf_counter() - start)
         return self
 
 
@@ -260,6 +719,12 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
         if not USE_PEFT_BACKEND:
             raise ValueError("PEFT backend is required for this method.")
 
+        # LoRA weights passed as a dict have no identity for the embedding cache
+        if isinstance(pretrained_model_name_or_path_or_dict, str):
+            lora_identity = pretrained_model_name_or_path_or_dict
+        else:
+            lora_identity = None
+
         # if a dict is passed, copy it instead of modifying it inplace
         if isinstance(pretrained_model_name_or_path_or_dict, dict):
             pretrained_model_name_or_path_or_dict = pretrained_model_name_or_path_or_dict.copy()
@@ -294,9 +759,27 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
         )
 
         self.k_model = KModel(unet=self.unet)
+        self.lora_identity = lora_identity
+
+    def unload_lora_weights(self):
+        super().unload_lora_weights()
+        self.lora_identity = ''
+        return
+
+    def tokenize_subprompts(self, subprompts: list[str]):
+        # Token ids without special tokens from both tokenizers, through the tokenization cache
+        ids_t1 = self.tokenization_cache.tokenize(self.tokenizer, subprompts)
+
+        if self.tokenizers_share_vocabulary is None:
+            self.tokenizers_share_vocabulary = tokenizers_share_vocabulary(self.tokenizer, self.tokenizer_2)
+
+        if self.tokenizers_share_vocabulary:
+            return ids_t1, ids_t1
+
+        return ids_t1, self.tokenization_cache.tokenize(self.tokenizer_2, subprompts)
 
     @torch.inference_mode()
-    def encode_bag_of_subprompts_greedy(self, prefixes: list[str], suffixes: list[str], lora_scale=None):
+    def tokenize_bag_of_subprompts_greedy(self, prefixes: list[str], suffixes: list[str]):
         device = self.text_encoder.device
 
         @torch.inference_mode()
@@ -341,63 +824,19 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
 
             return dict(
                 ids_t1=get_77_tokens_in_torch(merged_ids_t1, self.tokenizer),
-                ids_t2=get_77_tokens_in_torch(merged_ids_t2, self.tokenizer_2)
+                ids_t2=get_77_tokens_in_torch(merged_ids_t2, self.tokenizer_2),
+                prefix_length=1 + min(prefix_length, 75)  # bos and prefix tokens shared by all chunks
             )
 
-        @torch.inference_mode()
-        def double_encode(pair_of_inds, lora_scale = None):
-            inds = [pair_of_inds['ids_t1'], pair_of_inds['ids_t2']]
-            text_encoders = [self.text_encoder, self.text_encoder_2]
-            if lora_scale is not None and isinstance(self, StableDiffusionXLLoraLoaderMixin):
-                self._lora_scale = lora_scale
-
-                # dynamically adjust the LoRA scale
-                if self.text_encoder is not None:
-                    if not USE_PEFT_BACKEND:
-                        adjust_lora_scale_text_encoder(self.text_encoder, lora_scale)
-                    else:
-                        scale_lora_layers(self.text_encoder, lora_scale)
-
-                if self.text_encoder_2 is not None:
-                    if not USE_PEFT_BACKEND:
-                        adjust_lora_scale_text_encoder(self.text_encoder_2, lora_scale)
-                    else:
-                        scale_lora_layers(self.text_encoder_2, lora_scale)
-
-            pooled_prompt_embeds = None
-            prompt_embeds_list = []
-
-            for text_input_ids, text_encoder in zip(inds, text_encoders):
-                prompt_embeds = text_encoder(text_input_ids, output_hidden_states=True)
-
-                # Only last pooler_output is needed
-                pooled_prompt_embeds = prompt_embeds.pooler_output
-
-                # "2" because SDXL always indexes from the penultimate layer.
-                prompt_embeds = prompt_embeds.hidden_states[-2]
-                prompt_embeds_list.append(prompt_embeds)
-
-            prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
-            if self.text_encoder is not None:
-                if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
-                    # Retrieve the original scale by scaling back the LoRA layers
-                    unscale_lora_layers(self.text_encoder, lora_scale)
-
-            if self.text_encoder_2 is not None:
-                if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
-                    # Retrieve the original scale by scaling back the LoRA layers
-                    unscale_lora_layers(self.text_encoder_2, lora_scale)
-            return prompt_embeds, pooled_prompt_embeds
-
         # Begin with tokenizing prefixes
 
         prefix_length = 0
         prefix_ids_t1 = []
         prefix_ids_t2 = []
 
-        for prefix in prefixes:
-            ids_t1 = self.tokenizer(prefix, truncation=False, add_special_tokens=False).input_ids
-            ids_t2 = self.tokenizer_2(prefix, truncation=False, add_special_tokens=False).input_ids
+        all_ids_t1, all_ids_t2 = self.tokenize_subprompts(prefixes + suffixes)
+
+        for ids_t1, ids_t2 in zip(all_ids_t1[:len(prefixes)], all_ids_t2[:len(prefixes)]):
             assert len(ids_t1) == len(ids_t2)
             prefix_length += len(ids_t1)
             prefix_ids_t1 += ids_t1
@@ -408,11 +847,11 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
         allowed_suffix_length = 75 - prefix_length
         suffix_targets = []
 
-        for subprompt in suffixes:
+        for ids_t1, ids_t2 in zip(all_ids_t1[len(prefixes):], all_ids_t2[len(prefixes):]):
             # Note that all subprompt are theoretically less than 75 tokens (without bos/eos)
             # So we can safely just crop it to 75
-            ids_t1 = self.tokenizer(subprompt, truncation=False, add_special_tokens=False).input_ids[:75]
-            ids_t2 = self.tokenizer_2(subprompt, truncation=False, add_special_tokens=False).input_ids[:75]
+            ids_t1 = ids_t1[:75]
+            ids_t2 = ids_t2[:75]
             assert len(ids_t1) == len(ids_t2)
             suffix_targets.append(dict(
                 length=len(ids_t1),
@@ -422,58 +861,198 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
 
         # Then merge prefix and suffix tokens
 
-        suffix_targets = greedy_partition(suffix_targets, max_sum=allowed_suffix_length)
+        greedy_bags = greedy_partition(suffix_targets, max_sum=allowed_suffix_length)
+
+        if self.chunk_packing == 'first_fit_decreasing':
+            suffix_targets = first_fit_decreasing_partition(suffix_targets, max_sum=allowed_suffix_length)
+        elif self.chunk_packing == 'optimal':
+            suffix_targets = optimal_partition(suffix_targets, max_sum=allowed_suffix_length)
+        else:
+            suffix_targets = greedy_bags
+
+        self.chunk_packing_stats['chunks'] += len(suffix_targets)
+        self.chunk_packing_stats['greedy_chunks'] += len(greedy_bags)
+
         targets = [merge_with_prefix(b) for b in suffix_targets]
 
-        # Encode!
+        return targets
+
+    @torch.inference_mode()
+    def double_encode(self, targets, lora_scale=None):
+        # Encodes a batch of 77-token chunks, taking the chunks found in the embedding cache from there.
+        # Without a LoRA the scale has no effect, so all scales share the cache entries of no scale.
+        if self.lora_identity == '':
+            lora_scale = None
+
+        if self.embedding_cache is None or self.model_identity is None or self.lora_identity is None:
+            return self.double_encode_uncached(targets, lora_scale)
+
+        device = self.text_encoder.device
+        keys = [self.embedding_cache.make_key(self.model_identity, self.lora_identity, lora_scale,
+                                              t['ids_t1'], t['ids_t2']) for t in targets]
+        results = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        if len(missing) > 0:
+            conds, poolers = self.double_encode_uncached([targets[i] for i in missing], lora_scale)
+            for j, i in enumerate(missing):
+                results[i] = conds[j], poolers[j]
+                self.embedding_cache.put(keys[i], conds[j], poolers[j])
+
+        conds = torch.stack([cond.to(device) for cond, pooler in results], dim=0)
+        poolers = torch.stack([pooler.to(device) for cond, pooler in results], dim=0)
+        return conds, poolers
+
+    @torch.inference_mode()
+    def double_encode_uncached(self, targets, lora_scale=None):
+        # Encodes a batch of 77-token chunks with both text encoders in one forward each
+        inds = [torch.cat([t['ids_t1'] for t in targets], dim=0), torch.cat([t['ids_t2'] for t in targets], dim=0)]
+        text_encoders = [self.text_encoder, self.text_encoder_2]
+        if lora_scale is not None and isinstance(self, StableDiffusionXLLoraLoaderMixin):
+            self._lora_scale = lora_scale
+
+            # dynamically adjust the LoRA scale
+            if self.text_encoder is not None:
+                if not USE_PEFT_BACKEND:
+                    adjust_lora_scale_text_encoder(self.text_encoder, lora_scale)
+                else:
+                    scale_lora_layers(self.text_encoder, lora_scale)
+
+            if self.text_encoder_2 is not None:
+                if not USE_PEFT_BACKEND:
+                    adjust_lora_scale_text_encoder(self.text_encoder_2, lora_scale)
+                else:
+                    scale_lora_layers(self.text_encoder_2, lora_scale)
+
+        pooled_prompt_embeds = None
+        prompt_embeds_list = []
+
+        for text_input_ids, text_encoder in zip(inds, text_encoders):
+            if self.prefix_reuse_encoding:
+                prompt_embeds, pooled_prompt_embeds = encode_with_shared_prefixes(
+                    text_encoder, text_input_ids, [t['prefix_length'] for t in targets])
+                prompt_embeds_list.append(prompt_embeds)
+                continue
+
+            prompt_embeds = text_encoder(text_input_ids, output_hidden_states=True)
 
-        conds, poolers = [], []
+            # Only last pooler_output is needed
+            pooled_prompt_embeds = prompt_embeds.pooler_output
+
+            # "2" because SDXL always indexes from the penultimate layer.
+            prompt_embeds = prompt_embeds.hidden_states[-2]
+            prompt_embeds_list.append(prompt_embeds)
+
+        prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+        if self.text_encoder is not None:
+            if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
+                # Retrieve the original scale by scaling back the LoRA layers
+                unscale_lora_layers(self.text_encoder, lora_scale)
+
+        if self.text_encoder_2 is not None:
+            if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
+                # Retrieve the original scale by scaling back the LoRA layers
+                unscale_lora_layers(self.text_encoder_2, lora_scale)
+        return prompt_embeds, pooled_prompt_embeds
 
-        for target in targets:
-            cond, pooler = double_encode(target, lora_scale)
-            conds.append(cond)
-            poolers.append(pooler)
+    @torch.inference_mode()
+    def encode_bag_of_subprompts_greedy(self, prefixes: list[str], suffixes: list[str], lora_scale=None):
+        targets = self.tokenize_bag_of_subprompts_greedy(prefixes=prefixes, suffixes=suffixes)
+        conds, poolers = self.double_encode(targets, lora_scale)
 
-        conds_merged = torch.concat(conds, dim=1)
-        poolers_merged = poolers[0]
+        # Chunks are concatenated along the token axis, and only the first chunk's pooler is used
+        conds_merged = conds.reshape(1, -1, conds.size(-1))
+        poolers_merged = poolers[:1]
 
         return dict(cond=conds_merged, pooler=poolers_merged)
 
+    @torch.inference_mode()
+    def encode_condition_early(self, prefixes: list[str], suffixes: list[str], lora_scale=None, activation_text=None):
+        # Encodes one item of bag_of_conditions into the embedding cache before all_conds_from_canvas needs it,
+        # e.g. while the LLM is still writing the rest of the canvas. Returns whether it encoded anything.
+        if self.embedding_cache is None:
+            return False
+
+        # Text encoders that were unloaded to make room for the LLM would run in float16 on the CPU, slowly and
+        # with results that differ from the device ones under the same cache key
+        compute_device = memory_management.device
+        if compute_device is not None and self.text_encoder.device.type != compute_device.type:
+            return False
+
+        if activation_text is not None:
+            prefixes = [activation_text] + suffixes
+
+        self.double_encode(self.tokenize_bag_of_subprompts_greedy(prefixes=prefixes, suffixes=suffixes), lora_scale)
+        return True
+
     @torch.inference_mode()
     def all_conds_from_canvas(self, canvas_outputs, negative_prompt, lora_scale=None, activation_text = None):
-        mask_all = torch.ones(size=(90, 90), dtype=torch.float32)
-        negative_cond, negative_pooler = self.encode_cropped_prompt_77tokens(negative_prompt)
-        negative_result = [(mask_all, negative_cond)]
+        mask_all = Region()
+        negative_target = self.tokenize_cropped_prompt_77tokens(negative_prompt)
 
-        positive_result = []
-        positive_pooler = None
+        masks = []
+        targets = []
+        chunk_counts = []
+        greedy_chunks_before = self.chunk_packing_stats['greedy_chunks']
+
+        # Tokenize all distinct subprompts of the canvas with one call per tokenizer
+        all_subprompts = [x for item in canvas_outputs['bag_of_conditions'] for x in item['prefixes'] + item['suffixes']]
+        if activation_text is not None:
+            all_subprompts.append(activation_text)
+        self.tokenize_subprompts(list(dict.fromkeys(all_subprompts)))
 
         for item in canvas_outputs['bag_of_conditions']:
-            current_mask = torch.from_numpy(item['mask']).to(torch.float32)
+            current_mask = item['mask']
+            if not isinstance(current_mask, Region):
+                current_mask = torch.from_numpy(current_mask).to(torch.float32)
             current_prefixes = item['prefixes']
             current_suffixes = item['suffixes']
             if activation_text is not None:
                 current_prefixes = [activation_text] + current_suffixes
                 print(f"Updated current prefixes: {current_prefixes}")
-            current_cond = self.encode_bag_of_subprompts_greedy(prefixes=current_prefixes, suffixes=current_suffixes,
-                                                                lora_scale=lora_scale)
+            current_targets = self.tokenize_bag_of_subprompts_greedy(prefixes=current_prefixes,
+                                                                     suffixes=current_suffixes)
+            masks.append(current_mask)
+            targets.extend(current_targets)
+            chunk_counts.append(len(current_targets))
+
+        if self.chunk_packing != 'greedy':
+            saved_chunks = self.chunk_packing_stats['greedy_chunks'] - greedy_chunks_before - len(targets)
+            print(f'Chunk packing [{self.chunk_packing}]: {len(targets)} chunks, '
+                  f'saved {saved_chunks} chunks ({saved_chunks * 77} tokens) over greedy')
+
+        # Encode the chunks of all regions as one batch per text encoder.
+        # The negative prompt is encoded without LoRA scale, so it can only join the batch when no scale is set,
+        # or when no LoRA is loaded and the scale has no effect (e.g. the scale of 0 the app uses without a LoRA).
+
+        if lora_scale is None or self.lora_identity == '':
+            conds, poolers = self.double_encode(targets + [negative_target])
+            negative_cond, negative_pooler = conds[-1:], poolers[-1:]
+            conds, poolers = conds[:-1], poolers[:-1]
+        else:
+            conds, poolers = self.double_encode(targets, lora_scale)
+            negative_cond, negative_pooler = self.double_encode([negative_target])
 
-            if positive_pooler is None:
-                positive_pooler = current_cond['pooler']
+        negative_cond = negative_cond.to(dtype=self.unet.dtype, device=self.text_encoder.device)
+        negative_result = [(mask_all, negative_cond)]
 
-            positive_result.append((current_mask, current_cond['cond']))
+        positive_result = []
+        positive_pooler = poolers[:1]
+        offset = 0
+
+        for current_mask, count in zip(masks, chunk_counts):
+            current_cond = conds[offset:offset + count].reshape(1, -1, conds.size(-1))
+            positive_result.append((current_mask, current_cond))
+            offset += count
 
         return positive_result, positive_pooler, negative_result, negative_pooler
 
     @torch.inference_mode()
-    def encode_cropped_prompt_77tokens(self, prompt: str):
+    def tokenize_cropped_prompt_77tokens(self, prompt: str):
         device = self.text_encoder.device
-        tokenizers = [self.tokenizer, self.tokenizer_2]
-        text_encoders = [self.text_encoder, self.text_encoder_2]
+        inds = []
 
-        pooled_prompt_embeds = None
-        prompt_embeds_list = []
-        for tokenizer, text_encoder in zip(tokenizers, text_encoders):
+        for tokenizer in [self.tokenizer, self.tokenizer_2]:
             text_input_ids = tokenizer(
                 prompt,
                 padding="max_length",
@@ -481,17 +1060,14 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
                 truncation=True,
                 return_tensors="pt",
             ).input_ids
+            inds.append(text_input_ids.to(device))
 
-            prompt_embeds = text_encoder(text_input_ids.to(device), output_hidden_states=True)
+        return dict(ids_t1=inds[0], ids_t2=inds[1], prefix_length=0)
 
-            # Only last pooler_output is needed
-            pooled_prompt_embeds = prompt_embeds.pooler_output
-
-            # "2" because SDXL always indexes from the penultimate layer.
-            prompt_embeds = prompt_embeds.hidden_states[-2]
-            prompt_embeds_list.append(prompt_embeds)
-
-        prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+    @torch.inference_mode()
+    def encode_cropped_prompt_77tokens(self, prompt: str):
+        device = self.text_encoder.device
+        prompt_embeds, pooled_prompt_embeds = self.double_encode([self.tokenize_cropped_prompt_77tokens(prompt)])
         prompt_embeds = prompt_embeds.to(dtype=self.unet.dtype, device=device)
 
         return prompt_embeds, pooled_prompt_embeds
@@ -510,9 +1086,22 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
             pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
             negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
             cross_attention_kwargs: Optional[dict] = None,
+            cache_cross_attention_kv: bool = False,
+            cross_attention_mode: str = 'dense',
+            cross_attention_chunk_size: Optional[int] = None,
+            batch_cfg: bool = False,
+            sequential_offload: bool = False,
+            sequential_offload_block_bytes: Optional[int] = None,
     ):
 
-        device = self.unet.device
+        if sequential_offload:
+            # The UNet stays on the CPU, its blocks are streamed to the device while sampling
+            if self.unet_offload is None or self.unet_offload.max_block_bytes != sequential_offload_block_bytes:
+                self.unet_offload = memory_management.SequentialBlockOffload(
+                    self.unet, memory_management.get_device(), max_block_bytes=sequential_offload_block_bytes)
+            device = self.unet_offload.device
+        else:
+            device = self.unet.device
         cross_attention_kwargs = cross_attention_kwargs or None
         text_encoder_lora_scale = cross_attention_kwargs.get("scale", None) if cross_attention_kwargs is not None else None
 
@@ -558,9 +1147,14 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
         latents = latents.to(device)
         add_time_ids = add_time_ids.repeat(batch_size, 1).to(device)
         add_neg_time_ids = add_neg_time_ids.repeat(batch_size, 1).to(device)
-        prompt_embeds = [(k.to(device), v.repeat(batch_size, 1, 1).to(noise)) for k, v in prompt_embeds]
-        negative_prompt_embeds = [(k.to(device), v.repeat(batch_size, 1, 1).to(noise)) for k, v in
-                                  negative_prompt_embeds]
+        prompt_embeds = RegionalConditions(
+            ((k, v.repeat(batch_size, 1, 1).to(noise)) for k, v in prompt_embeds),
+            cache_kv=cache_cross_attention_kv, attention_mode=cross_attention_mode,
+            query_chunk_size=cross_attention_chunk_size)
+        negative_prompt_embeds = RegionalConditions(
+            ((k, v.repeat(batch_size, 1, 1).to(noise)) for k, v in negative_prompt_embeds),
+            cache_kv=cache_cross_attention_kv, attention_mode=cross_attention_mode,
+            query_chunk_size=cross_attention_chunk_size)
         pooled_prompt_embeds = pooled_prompt_embeds.repeat(batch_size, 1).to(noise)
         negative_pooled_prompt_embeds = negative_pooled_prompt_embeds.repeat(batch_size, 1).to(noise)
 
@@ -580,9 +1174,37 @@ class StableDiffusionXLOmostPipeline(StableDiffusionXLImg2ImgPipeline):
             )
         )
 
+        if batch_cfg:
+            # Run both CFG branches as one UNet forward with twice the batch size
+            sampler_kwargs['batched'] = dict(
+                encoder_hidden_states=BatchedRegionalConditions([prompt_embeds, negative_prompt_embeds]),
+                added_cond_kwargs={
+                    "text_embeds": torch.cat([pooled_prompt_embeds, negative_pooled_prompt_embeds], dim=0),
+                    "time_ids": torch.cat([add_time_ids, add_neg_time_ids], dim=0)
+                },
+                cross_attention_kwargs=cross_attention_kwargs
+            )
+
         # Sample
 
-        results = sample_dpmpp_2m(self.k_model, latents, sigmas, extra_args=sampler_kwargs, disable=False)
+        if sequential_offload:
+            self.unet_offload.install()
+            try:
+                results = sample_dpmpp_2m(self.k_model, latents, sigmas, extra_args=sampler_kwargs, disable=False)
+            finally:
+                self.unet_offload.remove()
+            stats = self.unet_offload.stats()
+            print(f'Sequential offload: {stats["blocks"]} blocks, '
+                  f'peak resident {stats["peak_resident_bytes"] / (1024 ** 2):.2f} MB '
+                  f'of {stats["model_bytes"] / (1024 ** 2):.2f} MB')
+        else:
+            results = sample_dpmpp_2m(self.k_model, latents, sigmas, extra_args=sampler_kwargs, disable=False)
+
+        if cache_cross_attention_kv:
+            kv_bytes = prompt_embeds.kv_cache_bytes() + negative_prompt_embeds.kv_cache_bytes()
+            print(f'Cross-attention K/V cache: {kv_bytes / (1024 ** 2):.2f} MB')
+            prompt_embeds.clear_kv_cache()
+            negative_prompt_embeds.clear_kv_cache()
 
         # Reset the LoRA scale if applicable
         if text_encoder_lora_scale is not None and isinstance(self, StableDiffusionXLLoraLoaderMixin):
@@ -0,0 +1,88 @@
+import time
+import random
+import difflib
+
+import numpy as np
+import pytest
+
+from lib_omost.canvas import Canvas, closest_name, parse_canvas_code_fast, parse_canvas_code_ast, process_canvases, \
+    valid_colors, valid_locations, valid_offsets, valid_areas
+
+
+def test_fast_parser_long_numeric_arguments_do_not_backtrack():
+    # Each number must match in one way only, or a failing match tries every split of every digit run
+    for number in ['11111111111111111111', '1.111111111e111111', '-.5', '+3.0E-2']:
+        code = 'canvas = Canvas()\ncanvas.set_global_description(' + f'{number}, ' * 1000 + 'x)'
+        start = time.perf_counter()
+        assert parse_canvas_code_fast(code) is None
+        assert time.perf_counter() - start < 1.0
+
+
+def test_fast_parser_numbers_match_ast_parser():
+    for number in ['1', '1.', '.5', '10.25', '1.5e3', '-2', '+3.0E-2', '1e5']:
+        code = f"canvas = Canvas()\ncanvas.add_local_description({number}, {number}, distance_to_viewer={number})\n"
+        assert parse_canvas_code_fast(code) == parse_canvas_code_ast(code)[0]
+
+
+def test_fast_parser_leaves_oversized_integers_to_ast_parser():
+    code = 'canvas = Canvas()\ncanvas.set_global_description(' + '1' * 5000 + ', 2)'
+    assert parse_canvas_code_fast(code) is None
+    with pytest.raises(AssertionError, match='line 2'):
+        parse_canvas_code_ast(code)
+
+
+def test_closest_name_matches_difflib():
+    rng = random.Random(0)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz -'
+
+    for options in [valid_colors, valid_locations, valid_offsets, valid_areas]:
+        names = list(options.keys())
+        for _ in range(300):
+            query = list(rng.choice(names))
+            for _ in range(rng.randint(0, 6)):
+                i = rng.randrange(len(query))
+                query[i] = rng.choice(alphabet)
+            query = ''.join(query)
+
+            expected = difflib.get_close_matches(query, names, n=1, cutoff=0.5)
+            if len(expected) == 0:
+                with pytest.raises(AssertionError):
+                    closest_name(query, options)
+            else:
+                assert closest_name(query, options) == expected[0]
+
+
+def random_canvas(rng, n):
+    canvas = Canvas()
+    canvas.set_global_description('A scene.', ['Detail.'], 'a, b', rng.choice(list(valid_colors)))
+    for i in range(n):
+        canvas.add_local_description(
+            location=rng.choice(list(valid_locations)),
+            offset=rng.choice(list(valid_offsets)),
+            area=rng.choice(list(valid_areas)),
+            distance_to_viewer=float(rng.randint(1, 4)),
+            description=f'Thing {i}.',
+            detailed_descriptions=['Detail.'],
+            tags='c, d',
+            atmosphere='calm',
+            style='photo',
+            quality_meta='high',
+            HTML_web_color_name=rng.choice(list(valid_colors)),
+        )
+    return canvas
+
+
+def test_process_canvases_matches_process():
+    rng = random.Random(0)
+    canvases = [random_canvas(rng, n) for n in [0, 1, 3, 8, 5]]
+    batch = process_canvases(canvases, return_masks=True)
+
+    for i, canvas in enumerate(canvases):
+        outputs = canvas.process()
+        assert np.array_equal(batch['initial_latent'][i], outputs['initial_latent'])
+
+        regions = outputs['bag_of_conditions'][1:]
+        assert batch['counts'][i] == len(regions)
+        for k, item in enumerate(regions):
+            assert tuple(batch['rects'][i, k]) == item['mask'].rect
+            assert np.array_equal(batch['masks'][i, k], np.asarray(item['mask']))
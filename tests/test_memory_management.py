@@ -0,0 +1,117 @@
+import time
+import threading
+
+import torch
+
+from lib_omost.memory_management import ModelResidencyManager
+
+
+class FakeModel(torch.nn.Module):
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.device = 'cpu'
+        return
+
+
+def fake_move(m, device, non_blocking=False):
+    time.sleep(m.delay if hasattr(m, 'delay') else 0.0)
+    m.device = device
+    return
+
+
+def fake_manager(budget_bytes):
+    return ModelResidencyManager('fake', 'cpu', budget_bytes=budget_bytes, move_fn=fake_move,
+                                 size_fn=lambda m: m.size, name_fn=lambda m: f'model_{m.size}')
+
+
+def test_unloads_least_recently_used_models_over_budget():
+    manager = fake_manager(100)
+    a, b, c = FakeModel(40), FakeModel(50), FakeModel(30)
+
+    manager.load([a])
+    manager.load([b])
+    manager.load([a])
+    manager.load([c])
+
+    assert list(manager.resident.keys()) == [a, c]
+    assert (a.device, b.device, c.device) == ('fake', 'cpu', 'fake')
+
+
+def test_budget_zero_keeps_only_last_request_and_none_keeps_all():
+    manager = fake_manager(0)
+    a, b = FakeModel(10), FakeModel(20)
+    manager.load([a, b])
+    manager.load([b])
+    assert list(manager.resident.keys()) == [b]
+
+    manager = fake_manager(None)
+    a, b = FakeModel(10), FakeModel(20)
+    manager.load([a])
+    manager.load([b])
+    assert list(manager.resident.keys()) == [a, b]
+
+
+def test_prefetch_is_skipped_when_it_does_not_fit_next_to_active_models():
+    manager = fake_manager(100)
+    a, b, c = FakeModel(60), FakeModel(50), FakeModel(40)
+
+    manager.load([a])
+    manager.prefetch([b])
+    assert len(manager.prefetching) == 0
+
+    manager.prefetch([c])
+    manager.wait_for_prefetch([c])
+    assert c in manager.resident and a in manager.resident
+    assert manager.stats()['prefetches'] == 1
+
+
+def test_load_of_resident_model_does_not_wait_for_prefetch():
+    manager = fake_manager(None)
+    a, b = FakeModel(10), FakeModel(20)
+    b.delay = 0.5
+
+    manager.load([a])
+    manager.prefetch([b])
+    start = time.perf_counter()
+    manager.load([a])
+    assert time.perf_counter() - start < 0.25
+
+    manager.load([b])
+    assert b.device == 'fake'
+    assert len(manager.prefetching) == 0 and len(manager.incoming) == 0
+
+
+def test_stats_count_transfers_per_model():
+    manager = fake_manager(0)
+    a, b = FakeModel(10), FakeModel(20)
+
+    manager.load([a])
+    manager.load([b])
+    manager.load([a])
+    stats = manager.stats()
+
+    assert (stats['loads'], stats['unloads']) == (3, 2)
+    assert (stats['bytes_loaded'], stats['bytes_unloaded']) == (40, 30)
+    assert stats['resident'] == {'model_10': 10}
+    assert stats['models']['model_10']['loads'] == 2
+    assert stats['models']['model_20']['unloads'] == 1
+
+    manager.reset_stats()
+    assert manager.stats()['loads'] == 0
+
+
+def test_stats_while_prefetching():
+    manager = fake_manager(None)
+    models = [FakeModel(i + 1) for i in range(50)]
+    for m in models:
+        m.delay = 0.001
+
+    thread = threading.Thread(target=lambda: [manager.prefetch([m]) for m in models])
+    thread.start()
+    while thread.is_alive():
+        manager.stats()
+    thread.join()
+
+    manager.wait_for_prefetch(models)
+    assert manager.stats()['resident_bytes'] == sum(m.size for m in models)
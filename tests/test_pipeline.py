@@ -0,0 +1,58 @@
+import torch
+
+from diffusers.models.attention_processor import Attention
+from transformers import CLIPTextConfig, CLIPTextModel
+
+from lib_omost.canvas import Region
+from lib_omost.pipeline import RegionalConditions, OmostCrossAttnProcessor, encode_with_shared_prefixes
+
+
+def regional_pairs(generator):
+    # The global region, overlapping rectangles, a dense mask, and a region that is empty at 16*12
+    dense_mask = (torch.rand(90, 90, generator=generator) > 0.5).to(torch.float32)
+    masks = [Region(), Region((0, 50, 0, 60)), Region((30, 90, 20, 90)), dense_mask, Region((10, 12, 10, 12))]
+    return [(m, torch.randn(2, 5 + i, 32, generator=generator)) for i, m in enumerate(masks)]
+
+
+def test_sdpa_and_sparse_attention_match_dense():
+    generator = torch.Generator().manual_seed(0)
+    torch.manual_seed(0)
+    attn = Attention(query_dim=48, cross_attention_dim=32, heads=4, dim_head=12).eval()
+    pairs = regional_pairs(generator)
+    H, W = 16, 12
+    hidden_states = torch.randn(2, H * W, 48, generator=generator)
+
+    outputs = {}
+    for mode, query_chunk_size in [('dense', None), ('sdpa', None), ('sdpa', 50), ('sparse', None)]:
+        conditions = RegionalConditions(pairs, attention_mode=mode, query_chunk_size=query_chunk_size)
+        with torch.no_grad():
+            outputs[mode, query_chunk_size] = OmostCrossAttnProcessor()(attn, hidden_states, conditions,
+                                                                        (2, 48, H, W))
+
+    reference = outputs['dense', None]
+    for key, output in outputs.items():
+        assert torch.isfinite(output).all(), key
+        assert torch.allclose(output, reference, atol=1e-5), key
+
+
+def test_prefix_reuse_matches_full_forward():
+    torch.manual_seed(0)
+    config = CLIPTextConfig(vocab_size=600, hidden_size=32, intermediate_size=37, num_hidden_layers=3,
+                            num_attention_heads=4, max_position_embeddings=77)
+    text_encoder = CLIPTextModel(config).eval()
+
+    # Rows of three regions sharing a global prefix of 12 tokens, and a row without a prefix
+    generator = torch.Generator().manual_seed(0)
+    prefix_lengths = [12, 20, 20, 31, 31, 31, 0]
+    input_ids = torch.randint(3, 500, (len(prefix_lengths), 77), generator=generator)
+    input_ids[:6, :12] = input_ids[0, :12]
+    input_ids[1:3, :20] = input_ids[1, :20]
+    input_ids[3:6, :31] = input_ids[3, :31]
+    input_ids[:, 60] = 2
+
+    with torch.no_grad():
+        outputs = text_encoder(input_ids, output_hidden_states=True)
+    states, pooled = encode_with_shared_prefixes(text_encoder, input_ids, prefix_lengths)
+
+    assert torch.allclose(states, outputs.hidden_states[-2], atol=1e-6)
+    assert torch.allclose(pooled, outputs.pooler_output, atol=1e-6)